@@ -15,6 +15,18 @@ from image_transform_local import Image_transform
 # find script directory
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# size of the raw framebuffer of the 7.5 inch V2 panel : 800x480 pixels, 8 pixels per byte
+FRAMEBUFFER_SIZE = int(800 / 8) * 480
+
+# set to False to download the dashboard as a PNG and convert it on the Pi instead
+USE_FRAMEBUFFER = True
+
+# dithering of the local pictures : threshold, bayer, floyd-steinberg or atkinson (needs numpy)
+DITHERING = "floyd-steinberg"
+
+# file where we keep the ETag of the dashboard currently on the screen
+ETAG_PATH = os.path.join(dir_path, "last_etag.txt")
+
 #function to display image
 def show_image(image):
     try:
@@ -31,6 +43,42 @@ def show_image(image):
     finally:
         display.sleep()
 
+#function to display a framebuffer prepared by the server, sent straight to the screen without any conversion
+def show_buffer(buffer):
+    try:
+            # Display init, clear
+            display = epd7in5_V2.EPD()
+            display.init() #update 
+            
+            #display the buffer
+            display.display(buffer) 
+
+    except IOError as e:
+            print(e)
+
+    finally:
+        display.sleep()
+
+#functions to remember which dashboard is on the screen, so the server can tell us when nothing changed
+def read_last_etag():
+    try:
+        with open(ETAG_PATH) as etag_file:
+            return etag_file.read().strip()
+    except OSError:
+        return None
+
+def save_last_etag(etag):
+    if etag:
+        with open(ETAG_PATH, "w") as etag_file:
+            etag_file.write(etag)
+
+def clear_last_etag():
+    # the screen no longer shows a dashboard, the next one must be displayed whatever its ETag
+    try:
+        os.remove(ETAG_PATH)
+    except OSError:
+        pass
+
 def get_battery_percentage():
     try : 
         # capture input from command line
@@ -46,32 +94,69 @@ def get_battery_percentage():
 
 
 try:
-    # fetch web page
-    filename="https://dashboardpi-of6skuawsa-nn.a.run.app/dashboard_homepage"
+    if USE_FRAMEBUFFER:
+        # fetch the framebuffer, the server overlays the battery percentage for us
+        filename="https://dashboardpi-of6skuawsa-nn.a.run.app/dashboard_framebuffer"
+
+        # send the ETag of the dashboard on the screen : if it is unchanged, the server answers 304 with no body
+        last_etag = read_last_etag()
+        headers = {"If-None-Match": last_etag} if last_etag else {}
+
+        response = requests.get(filename, params={"battery": get_battery_percentage()}, headers=headers)
+        response.raise_for_status()
+
+        if response.status_code == 304:
+            # the screen already shows this dashboard, skip the refresh
+            print("Dashboard unchanged, keeping the current screen")
+
+        else:
+            # check that we received a whole frame before pushing it to the screen
+            if len(response.content) != FRAMEBUFFER_SIZE:
+                raise ValueError(f"Framebuffer has {len(response.content)} bytes instead of {FRAMEBUFFER_SIZE}")
+
+            #push it to the screen
+            show_buffer(response.content)
+            save_last_etag(response.headers.get("ETag"))
+
+    else:
+        # fetch web page
+        filename="https://dashboardpi-of6skuawsa-nn.a.run.app/dashboard_homepage"
+
+        # send the ETag of the dashboard on the screen : if it is unchanged, the server answers 304 with no body
+        last_etag = read_last_etag()
+        headers = {"If-None-Match": last_etag} if last_etag else {}
+
+        #pull image from web
+        response = requests.get(filename, stream=True, headers=headers)
+
+        if response.status_code == 304:
+            # the screen already shows this dashboard, skip the refresh
+            print("Dashboard unchanged, keeping the current screen")
 
-    #pull image from web
-    response = requests.get(filename, stream=True)
-    response.raw.decode_content = True
-    image = Image.open(response.raw)
+        else:
+            response.raw.decode_content = True
+            image = Image.open(response.raw)
 
-    # overlay battery percentage on image picked up from web
+            # overlay battery percentage on image picked up from web
 
-    updated_image = Image.new(mode="1", size=(800, 480), color=255) # create new image
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    font_path = os.path.join(script_dir, "fonts", "Roboto-Medium.ttf")
-    font = ImageFont.truetype(font_path, 15) # select font
-    updated_image.paste(image, (0, 0)) # paste dashboard on canvas
+            updated_image = Image.new(mode="1", size=(800, 480), color=255) # create new image
+            script_dir = os.path.dirname(os.path.realpath(__file__))
+            font_path = os.path.join(script_dir, "fonts", "Roboto-Medium.ttf")
+            font = ImageFont.truetype(font_path, 15) # select font
+            updated_image.paste(image, (0, 0)) # paste dashboard on canvas
 
-    draw = ImageDraw.Draw(updated_image) # create Draw
-    draw.text((90, 438), get_battery_percentage(), font=font, fill=0, align='center') # Add text to image
+            draw = ImageDraw.Draw(updated_image) # create Draw
+            draw.text((90, 438), get_battery_percentage(), font=font, fill=0, align='center') # Add text to image
 
-    #push it to the screen
-    show_image(updated_image)
+            #push it to the screen
+            show_image(updated_image)
+            save_last_etag(response.headers.get("ETag"))
 
 #if an error occurs (connection slow or missing), print a random local picture instead
 except Exception as e:
     local_datetime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     print(f"Exception occurred at {local_datetime}, printing local image instead : {e}")
+    clear_last_etag()
 
 
     pic_path = os.path.join(dir_path, "pics")
@@ -88,6 +173,6 @@ except Exception as e:
 
     #run the local function to process and display it
     local_image=Image_transform(imported_image=random_image)
-    image=local_image.render(fit="crop")
+    image=local_image.render(fit="crop", dithering=DITHERING)
     show_image(image)
 
@@ -0,0 +1 @@
+../server/dithering.py
\ No newline at end of file
@@ -2,14 +2,17 @@ import os
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import textwrap
 
+from dithering import dither
+
 
 #function to transform the pic pulled from gmail into a 2 tone & resized image
 class Image_transform:
     def __init__(self, imported_image):
         self.imported_image=imported_image
 
-    def render(self, fit="crop"):
+    def render(self, fit="crop", dithering="floyd-steinberg"):
         # fit can be "width" or "crop" or "height"
+        # dithering can be "threshold", "bayer", "floyd-steinberg" or "atkinson" (same module as the server)
         #we are using the screen in portrait mode and so flipping the default landscape mode
         w = 480
         h = 800
@@ -36,7 +39,7 @@ class Image_transform:
             adjust_height=int(blank_space/2)
             
             #paste on canvas with height adjustment
-            canvas.paste(image, (0, 0+adjust_height))
+            canvas.paste(dither(image, dithering), (0, 0+adjust_height))
 
         #option 2 : fit the whole height to the frame
         if fit=="height":
@@ -50,7 +53,7 @@ class Image_transform:
             blank_space=h-image.size[1]
             adjust_height=int(blank_space/2)
             #Paste image on canvas
-            canvas.paste(image, (0, 0+adjust_height))
+            canvas.paste(dither(image, dithering), (0, 0+adjust_height))
 
         #option 3 : crop the image in the center 
         if fit=="crop":
@@ -70,7 +73,7 @@ class Image_transform:
             image = image.crop((left, top, right, bottom))
 
             #Paste image on canvas
-            canvas.paste(image, (0, 0))
+            canvas.paste(dither(image, dithering), (0, 0))
         
         return(canvas)
 
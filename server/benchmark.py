@@ -0,0 +1,292 @@
+# Small benchmarks for the dashboard render pipeline.
+# Run from the server folder: python benchmark.py, or only some of them: python benchmark.py static_layer pillow_renderer
+# The rasterization benchmarks need cairo, e.g. in the server image: docker run --rm <image> python benchmark.py pillow_renderer
+
+import os
+import sys
+import copy
+import time
+import gc
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from io import BytesIO
+from PIL import Image, ImageChops, ImageOps, ImageStat, ExifTags
+
+from svg_updater import SVGFile
+from eink_image import Image_transform, rasterize_svg
+from render_plan import RenderPlan, PlannedSVGFile, matches_svg_file
+from pillow_renderer import PillowLayout, PillowSVGFile
+
+# Get the absolute path of the directory of the current script
+dir_path = os.path.dirname(os.path.realpath(__file__))
+TEMPLATE_PATH = os.path.join(dir_path, "svg_template.svg")
+
+# Number of trees held at once, one per gunicorn thread
+CONCURRENT_RENDERS = 8
+
+# Representative arguments of SVGFile.update_svg
+SAMPLE_DASHBOARD_DATA = {
+    "current_weather_dict": {"temp": "3°C", "humidex": "N/A", "humidity": "80% h.r.", "uv_index": 4, "weather_icon": 2, "aqi": "3",
+                             "current_date": "Samedi 18 octobre 2025, 06:01", "sunrise": "07:12", "sunset": "18:09"},
+    "forecast_period_1_dict": {"title": "Aujourd'hui", "forecast": "Nuageux avec éclaircies. Risque d'averses en après-midi. Vents du sud-ouest de 20 km/h",
+                               "temp": "12°C", "temp_type": "high", "weather_icon": 6, "precip": "40%", "aqi": "AQI: 3"},
+    "forecast_period_2_dict": {"title": "Ce soir", "forecast": "Dégagé. Minimum moins 2.", "temp": "-2°C", "temp_type": "low",
+                               "weather_icon": 30, "precip": "0%", "aqi": "AQI: 2"},
+    "grocery_dict": {"grocery_list": ["lait", "pain", "œufs", "fromage", "pommes"]},
+    "calendar_dict": {"calendar_events": ["Aujourd'hui:", "•\u00A0Dentiste", "Demain:", "•\u00A0Souper chez des amis"]},
+}
+
+
+def time_per_call(func, repeat=50):
+    """Return the average duration of func() in milliseconds."""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def resident_memory():
+    """Return the resident set size of this process in bytes (Linux only, 0 elsewhere)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def memory_per_call(func, count=CONCURRENT_RENDERS):
+    """Return the resident memory growth, in kB, of holding `count` results of func() at once."""
+    gc.collect()
+    before = resident_memory()
+    results = [func() for _ in range(count)]
+    growth = resident_memory() - before
+    del results
+    gc.collect()
+    return growth / count / 1024
+
+
+def bench_template_loading():
+    # Previous behaviour: every request parses the template from disk
+    def parse_from_disk():
+        return etree.parse(TEMPLATE_PATH)
+
+    # Current behaviour: the template is parsed once, each request gets a private copy
+    def copy_cached_template():
+        template, id_index, group_index, hidden_classes = SVGFile.load_template(TEMPLATE_PATH)
+        return copy.deepcopy(template)
+
+    print(f"Template: {TEMPLATE_PATH} ({os.path.getsize(TEMPLATE_PATH) / 1024:.0f} kB)")
+    print(f"  etree.parse per request   : {time_per_call(parse_from_disk):7.2f} ms, {memory_per_call(parse_from_disk):7.0f} kB")
+    print(f"  copy of cached template   : {time_per_call(copy_cached_template):7.2f} ms, {memory_per_call(copy_cached_template):7.0f} kB")
+
+
+def updated_svg():
+    # Return an SVGFile filled with the sample data, without the handlers' logging
+    final_svg = SVGFile(template_svg_filepath=TEMPLATE_PATH)
+    with contextlib.redirect_stdout(None):
+        final_svg.update_svg(**SAMPLE_DASHBOARD_DATA)
+    return final_svg
+
+
+def bench_update_svg():
+    print(f"  SVGFile + update_svg      : {time_per_call(updated_svg):7.2f} ms")
+
+
+def bench_render_plan():
+    # Fill the sample dashboard and serialize it for the rasterizer, with the lxml tree and with the compiled plan
+    def serialize(svg_class):
+        def fill_and_serialize():
+            final_svg = svg_class(template_svg_filepath=TEMPLATE_PATH)
+            with contextlib.redirect_stdout(None):
+                final_svg.update_svg(**SAMPLE_DASHBOARD_DATA)
+            final_svg.prune_hidden()
+            return final_svg.to_bytes()
+        return fill_and_serialize
+
+    start = time.perf_counter()
+    RenderPlan.load(TEMPLATE_PATH)
+    print(f"  render plan compilation   : {(time.perf_counter() - start) * 1000:7.2f} ms (once per process)")
+    check_render_plan()
+    print(f"  SVGFile update + serialize: {time_per_call(serialize(SVGFile)):7.2f} ms")
+    print(f"  render plan               : {time_per_call(serialize(PlannedSVGFile)):7.2f} ms")
+
+
+def render_plan_cases():
+    # The sample data, and edge cases of each handler: escaping, missing keys, empty lists, blocks longer than their max_lines
+    overflowing_words = " ".join(f"mot{index}" for index in range(200))
+    yield "sample data", SAMPLE_DASHBOARD_DATA
+    yield "escaping", {**SAMPLE_DASHBOARD_DATA,
+                       "current_weather_dict": {**SAMPLE_DASHBOARD_DATA["current_weather_dict"], "current_date": "<Samedi> & \"demain\" 'soir' ]]>"},
+                       "forecast_period_1_dict": {**SAMPLE_DASHBOARD_DATA["forecast_period_1_dict"], "forecast": "Pluie < 5 mm & vents > 40 km/h"},
+                       "grocery_dict": {"grocery_list": ["<b>lait</b>", "sel & poivre", "\"pain\""]},
+                       "calendar_dict": {"calendar_events": ["R&D <réunion>", "•\u00A0'Souper'"]}}
+    yield "missing keys", {"current_weather_dict": {"temp": "3°C"}, "forecast_period_1_dict": {}, "forecast_period_2_dict": {"title": "Ce soir"},
+                           "grocery_dict": {}, "calendar_dict": {}}
+    yield "empty lists", {**SAMPLE_DASHBOARD_DATA, "grocery_dict": {"grocery_list": []}, "calendar_dict": {"calendar_events": []}}
+    yield "overflowing blocks", {**SAMPLE_DASHBOARD_DATA,
+                                 "forecast_period_1_dict": {**SAMPLE_DASHBOARD_DATA["forecast_period_1_dict"], "forecast": overflowing_words},
+                                 "grocery_dict": {"grocery_list": [f"article {index}" for index in range(30)] + ["unmotbeaucouptroplongpourtenirsurlaligne"]},
+                                 "calendar_dict": {"calendar_events": [overflowing_words]}}
+
+
+def check_render_plan():
+    # The render plan must give the same bytes as SVGFile, for the sample data and the edge cases
+    mismatches = [label for label, dashboard_data in render_plan_cases() if not matches_svg_file(TEMPLATE_PATH, **dashboard_data)]
+    print(f"  byte-identical output     : {'no, ' + ', '.join(mismatches) + ' differ' if mismatches else 'yes'}")
+    if mismatches:
+        raise AssertionError(f"The render plan differs from SVGFile for: {', '.join(mismatches)}")
+
+
+def bench_pruning():
+    # Rasterize the sample dashboard with and without its hidden elements
+    full_svg = updated_svg().to_bytes()
+    pruned = updated_svg()
+    pruned.prune_hidden()
+    pruned_svg = pruned.to_bytes()
+
+    def count_elements(svg_bytes):
+        return sum(1 for _ in etree.fromstring(svg_bytes).iter(etree.Element))
+
+    def rasterize(svg_bytes):
+        return lambda: Image_transform(path_or_image=svg_bytes)
+
+    print("Rasterization of the sample dashboard:")
+    for label, svg_bytes in (("full tree", full_svg), ("hidden elements pruned", pruned_svg)):
+        print(f"  {label:<24}: {len(svg_bytes) / 1024:6.0f} kB, {count_elements(svg_bytes):4d} elements, "
+              f"{time_per_call(rasterize(svg_bytes), repeat=10):7.2f} ms, {memory_per_call(rasterize(svg_bytes)):7.0f} kB")
+
+
+def bench_static_layer():
+    # Rasterize the whole sample dashboard, or only its dynamic layer over the cached static layer
+    def full_render():
+        return updated_svg().rasterize().image
+
+    def layered_render():
+        return updated_svg().rasterize(use_static_layer=True).image
+
+    start = time.perf_counter()
+    SVGFile.load_static_layer(TEMPLATE_PATH)
+    print("Static layer:")
+    print(f"  static layer rasterization: {(time.perf_counter() - start) * 1000:7.2f} ms (once per process)")
+    print(f"  full render               : {time_per_call(full_render, repeat=10):7.2f} ms")
+    print(f"  dynamic layer + composite : {time_per_call(layered_render, repeat=10):7.2f} ms")
+
+    # The layered render falls back to a full render when both layers draw on the same pixels
+    static_layer, static_drawn = SVGFile.load_static_layer(TEMPLATE_PATH)
+    dynamic_svg = updated_svg()
+    dynamic_svg.prune_hidden()
+    dynamic_svg.remove_static_layer()
+    overlap = ImageChops.logical_and(static_drawn, SVGFile.drawn_pixels(rasterize_svg(dynamic_svg.to_bytes()))).getbbox()
+    print(f"  layers overlap            : {overlap or 'no, composited'}")
+
+    # Pixels that differ between both renders: the layered render must be pixel-identical
+    difference = ImageChops.logical_xor(full_render(), layered_render())
+    differing = difference.histogram()[255]
+    print(f"  differing pixels          : {differing}")
+    if differing:
+        raise AssertionError(f"The static layer changes {differing} pixels of the render, bounding box {difference.getbbox()}")
+
+
+def bench_pillow_renderer():
+    # Render the sample dashboard with the cairosvg backend and with the Pillow backend
+    def render(svg_class):
+        def fill_and_rasterize():
+            final_svg = svg_class(template_svg_filepath=TEMPLATE_PATH)
+            with contextlib.redirect_stdout(None):
+                final_svg.update_svg(**SAMPLE_DASHBOARD_DATA)
+            return final_svg.rasterize().image
+        return fill_and_rasterize
+
+    start = time.perf_counter()
+    PillowLayout.load(TEMPLATE_PATH)
+    print("Renderer backends:")
+    print(f"  pillow layout compilation : {(time.perf_counter() - start) * 1000:7.2f} ms (once per process)")
+    print(f"  cairosvg                  : {time_per_call(render(PlannedSVGFile), repeat=10):7.2f} ms")
+    print(f"  pillow                    : {time_per_call(render(PillowSVGFile), repeat=10):7.2f} ms")
+
+    # Pixel diff between both backends, and where the differences are
+    difference = ImageChops.logical_xor(render(PlannedSVGFile)(), render(PillowSVGFile)())
+    differing = difference.histogram()[255]
+    print(f"  differing pixels          : {differing} ({differing / (difference.width * difference.height):.2%}), "
+          f"bounding box {difference.getbbox()}")
+
+
+def large_photo(width=4032, height=3024, orientation=6):
+    """Return the bytes of a 12 MP phone-like JPEG, rotated by its EXIF orientation like most phone photos."""
+    noise = Image.effect_noise((width, height), 40)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    photo = Image.merge("RGB", (noise, gradient, ImageChops.add(noise, gradient, scale=2)))
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    output = BytesIO()
+    photo.save(output, format="JPEG", quality=90, exif=exif)
+    return output.getvalue()
+
+
+def render_photo_full_size(photo_bytes):
+    # Previous behaviour: decode at full size, then one LANCZOS resize
+    canvas = Image.new(mode="1", size=(480, 800), color=(255))
+    image = ImageOps.exif_transpose(Image.open(BytesIO(photo_bytes)))
+    wsize = int(image.size[0] * 800 / image.size[1])
+    image = image.resize((wsize, 800), Image.LANCZOS)
+    left, top = (image.size[0] - 480) / 2, (image.size[1] - 800) / 2
+    canvas.paste(image.crop((left, top, left + 480, top + 800)), (0, 0))
+    return canvas
+
+
+def render_photo_draft(photo_bytes):
+    # Current behaviour: JPEG draft mode and reducing_gap
+    return Image_transform(path_or_image=Image.open(BytesIO(photo_bytes))).render(height=800, width=480)
+
+
+def peak_resident_memory(reset=False):
+    """Return the peak resident set size of this process in bytes, and optionally reset it (Linux only, 0 elsewhere)."""
+    try:
+        with open("/proc/self/status") as status:
+            peak = next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmHWM:"))
+        if reset:
+            # Writing 5 to clear_refs resets the peak to the current resident set size
+            with open("/proc/self/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+        return peak
+    except (OSError, StopIteration):
+        return 0
+
+
+def cpu_and_peak_memory(render, photo_bytes, repeat=5):
+    """Return the CPU time per call (ms) and the peak resident memory growth (MB) of render(photo_bytes)."""
+    gc.collect()
+    peak_resident_memory(reset=True)
+    baseline = resident_memory()
+    start = time.process_time()
+    for _ in range(repeat):
+        render(photo_bytes)
+    cpu_time = (time.process_time() - start) / repeat * 1000
+    return cpu_time, (peak_resident_memory() - baseline) / 1024 / 1024
+
+
+def bench_photo_pipeline():
+    photo_bytes = large_photo()
+    print(f"Photo pipeline ({len(photo_bytes) / 1024 / 1024:.1f} MB JPEG, 4032x3024, EXIF orientation 6):")
+    for label, render in (("full-size decode", render_photo_full_size), ("draft + reducing_gap", render_photo_draft)):
+        # Each variant runs in a fresh process, memory freed by one would otherwise be reused by the other
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            cpu_time, peak_memory = executor.submit(cpu_and_peak_memory, render, photo_bytes).result()
+        print(f"  {label:<24}: {cpu_time:7.2f} ms CPU, peak +{peak_memory:6.1f} MB")
+
+    # Dithering patterns differ as soon as one pixel does, so compare the average tone of 8x8 blocks instead
+    before, after = (render(photo_bytes).convert("L").reduce(8) for render in (render_photo_full_size, render_photo_draft))
+    print(f"  tone difference (8x8 avg) : {ImageStat.Stat(ImageChops.difference(before, after)).mean[0] / 255:.2%}")
+
+
+BENCHMARKS = {"template_loading": bench_template_loading, "update_svg": bench_update_svg, "render_plan": bench_render_plan,
+              "pruning": bench_pruning, "static_layer": bench_static_layer, "pillow_renderer": bench_pillow_renderer,
+              "photo_pipeline": bench_photo_pipeline}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,48 @@
+import time
+import threading
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing data source for a while, instead of waiting on it at every request.
+
+    - closed: every call goes through
+    - open: after failure_threshold failures in a row, calls are refused for reset_timeout seconds
+    - half-open: then a single trial call goes through, it closes the circuit if it succeeds and opens it again otherwise
+    """
+
+    def __init__(self, name : str, failure_threshold : int = 3, reset_timeout : float = 300):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0  # failures in a row
+        self._opened_at = None  # monotonic time the circuit opened, None while it is closed
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        # Tell whether the source can be called now
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial_in_flight = True
+            print(f"{self.name} circuit half-open, trying the source again")
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"{self.name} circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or (self._opened_at is None and self._failures >= self.failure_threshold):
+                print(f"{self.name} circuit open for {self.reset_timeout:.0f} s after {self._failures} failures")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
@@ -0,0 +1,90 @@
+import json
+import time
+import datetime
+import threading
+
+from google.auth import _helpers
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+
+class CredentialStore:
+    """
+    Keep the Google credentials of each service in memory, shared by every request of this process.
+
+    Tokens are refreshed in the background before they expire, so requests (the Pi sends no session cookie)
+    get valid credentials without waiting on Google's token endpoint.
+    """
+
+    def __init__(self, refresh_margin : int = 300, check_interval : int = 60):
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)  # refresh tokens expiring within this delay
+        self.check_interval = check_interval  # seconds between two checks of the background thread
+        self._credentials = {}  # {service_name: Credentials}
+        self._locks = {}  # one lock per service, a slow refresh doesn't block the other services
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def _service_lock(self, service_name : str):
+        with self._lock:
+            return self._locks.setdefault(service_name, threading.Lock())
+
+    def _needs_refresh(self, credentials : Credentials) -> bool:
+        if not credentials.valid:
+            return True
+        if credentials.expiry is None:
+            return False  # the token never expires
+        # google-auth stores the expiry as a naive UTC datetime, compare it with the same clock as credentials.valid
+        return credentials.expiry - self.refresh_margin <= _helpers.utcnow()
+
+    def put(self, service_name : str, credentials : Credentials):
+        # Share credentials obtained elsewhere (e.g. at the end of the auth flow) with every client
+        with self._service_lock(service_name):
+            self._credentials[service_name] = credentials
+        self._start_refresher()
+
+    def get(self, service_name : str, token_json : str) -> Credentials:
+        """
+        Return valid credentials for the service, built from its token (the json stored in the env file) the first time.
+
+        Only the first call, or a call after the background refresh failed, waits on the token endpoint.
+        Raises google.auth.exceptions.RefreshError if the token can't be refreshed.
+        """
+        with self._service_lock(service_name):
+            credentials = self._credentials.get(service_name)
+            if credentials is None:
+                credentials = Credentials.from_authorized_user_info(json.loads(token_json))
+
+            if not credentials.valid:
+                print(f"{service_name} credentials not valid, refreshing")
+                credentials.refresh(Request())
+            self._credentials[service_name] = credentials
+
+        self._start_refresher()
+        return credentials
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name="credential-refresher", daemon=True)
+                self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.refresh_expiring()
+
+    def refresh_expiring(self):
+        # Refresh the credentials that expire soon, a failure is retried at the next check
+        with self._lock:
+            service_names = list(self._credentials)
+
+        for service_name in service_names:
+            with self._service_lock(service_name):
+                credentials = self._credentials[service_name]
+                if not self._needs_refresh(credentials):
+                    continue
+                try:
+                    credentials.refresh(Request())
+                    print(f"{service_name} credentials refreshed in the background")
+                except Exception as error:
+                    print(f"{service_name} credentials could not be refreshed in the background: {error!r}")
@@ -0,0 +1,116 @@
+# Dithering of photo frames to black and white for the e-paper screen.
+# Shared by the server and the Pi: screen/dithering.py is a symlink to server/dithering.py.
+# NumPy is only imported for Atkinson dithering, the other methods only need Pillow.
+
+import functools
+from PIL import Image, ImageChops
+
+DITHERING_METHODS = ("threshold", "bayer", "floyd-steinberg", "atkinson")
+
+# 8x8 ordered dithering matrix, values 0 to 63
+BAYER_MATRIX = [
+    [ 0, 32,  8, 40,  2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44,  4, 36, 14, 46,  6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [ 3, 35, 11, 43,  1, 33,  9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47,  7, 39, 13, 45,  5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+]
+
+# Atkinson spreads 6/8 of the error to the next two pixels and to three pixels of the next row and one of the row after: (dy, dx)
+# The neighbours are grouped so that two pixels of the same wavefront never spread error to the same pixel within a group,
+# e.g. (x, y) and (x - 2, y + 1) both reach (x - 1, y + 1), through (1, -1) and (0, 1): these are in different groups
+ATKINSON_GROUPS = [[(0, 1), (0, 2), (1, 1), (2, 0)], [(1, -1), (1, 0)]]
+
+
+def dither(image, method : str = "floyd-steinberg"):
+    """
+    Convert an image to mode "1" (0=black, 255=white) with the given dithering method.
+
+    - threshold: each pixel is black below 50% gray, no dithering (best for text and line art)
+    - bayer: ordered dithering with an 8x8 matrix, a regular pattern that doesn't move between similar frames
+    - floyd-steinberg: error diffusion, Pillow's default when converting to mode "1"
+    - atkinson: error diffusion that only spreads 3/4 of the error, for more contrast (needs NumPy)
+    """
+    # Color images are converted straight to mode "1" by Pillow, with a more precise gray level than converting to "L" first
+    if method == "threshold":
+        return image.convert("1", dither=Image.Dither.NONE)
+
+    if method == "floyd-steinberg":
+        # Pillow's error diffusion runs in C, row by row
+        return image.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+
+    gray = image.convert("L")
+
+    if method == "bayer":
+        # White where the pixel is lighter than the matrix's threshold at its position
+        return ImageChops.subtract(gray, bayer_thresholds(gray.size)).point(lambda value: 255 if value else 0, mode="1")
+
+    if method == "atkinson":
+        return atkinson(gray)
+
+    raise ValueError(f"Unknown dithering method {method}, use one of {', '.join(DITHERING_METHODS)}")
+
+
+@functools.lru_cache(maxsize=4)
+def bayer_thresholds(size):
+    # The Bayer matrix tiled over the whole frame, as gray levels. Cached since frames always have the same size
+    tile = Image.new("L", (8, 8))
+    tile.putdata([int((value + 0.5) * 256 / 64) for row in BAYER_MATRIX for value in row])
+
+    thresholds = Image.new("L", size)
+    for top in range(0, size[1], 8):
+        for left in range(0, size[0], 8):
+            thresholds.paste(tile, (left, top))
+    return thresholds
+
+
+@functools.lru_cache(maxsize=4)
+def wavefronts(width : int, height : int):
+    """
+    Return, for each wavefront, the flat indexes of its pixels and of the pixels they spread their error to,
+    in a buffer padded by 2 pixels on the left, right and bottom.
+
+    Pixel (x, y) is in wavefront x + 2y: every pixel it receives error from is in an earlier wavefront,
+    so all the pixels of a wavefront can be processed at once.
+    """
+    import numpy
+
+    padded_width = width + 4
+    fronts = []
+    for front in range(width + 2 * (height - 1)):
+        ys = numpy.arange(max(0, (front - width + 2) // 2), min(height - 1, front // 2) + 1)
+        indexes = ys * padded_width + front - 2 * ys + 2
+        targets = [numpy.stack([indexes + dy * padded_width + dx for dy, dx in group]) for group in ATKINSON_GROUPS]
+        fronts.append((indexes, targets))
+    return fronts
+
+
+def atkinson(gray):
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Atkinson dithering needs NumPy: pip install numpy")
+
+    width, height = gray.size
+    padded_width = width + 4
+
+    # Gray levels plus the error received so far, with room for the error spread past the edges
+    buffer = numpy.zeros((height + 2, padded_width), dtype=numpy.float32)
+    buffer[:height, 2:width + 2] = numpy.asarray(gray, dtype=numpy.float32)
+    buffer = buffer.ravel()
+    output = numpy.zeros_like(buffer, dtype=numpy.uint8)
+
+    for indexes, targets in wavefronts(width, height):
+        values = buffer[indexes]
+        white = values >= 128
+        output[indexes] = white
+        error = (values - white * 255) / 8
+        # One scatter per group of neighbours, the error is broadcast to each neighbour of the group
+        for group_targets in targets:
+            buffer[group_targets] += error
+
+    output = output.reshape(height + 2, padded_width)[:height, 2:width + 2] * 255
+    return Image.fromarray(numpy.ascontiguousarray(output)).convert("1", dither=Image.Dither.NONE)
@@ -1,25 +1,58 @@
 import os
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ExifTags
 import cairosvg
 from io import BytesIO
 
+from dithering import dither
+
+# Resolution of the 7.5 inch e-paper panel, in landscape mode
+DASHBOARD_WIDTH = 800
+DASHBOARD_HEIGHT = 480
+
+# Font used to overlay the battery percentage, same as the one used on the Pi
+FONT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fonts", "Roboto-Medium.ttf")
+
+
+def rasterize_svg(path_or_svg_bytes):
+    """Rasterize an SVG (filepath or serialized document) at the panel's resolution, on a white background, as a grayscale image."""
+    svg_source = {"bytestring": path_or_svg_bytes} if isinstance(path_or_svg_bytes, bytes) else {"url": path_or_svg_bytes}
+    png_image = cairosvg.svg2png(**svg_source, output_width=DASHBOARD_WIDTH, output_height=DASHBOARD_HEIGHT, background_color="white")
+    return Image.open(BytesIO(png_image)).convert("L")
+
 
 class Image_transform:
-    def __init__(self, path_or_image):
+    def __init__(self, path_or_image, rasterized_dashboard = False, dithering = "floyd-steinberg"):
         self._path_or_image = path_or_image
+        # Dithering of photos to black and white, one of dithering.DITHERING_METHODS
+        self._dithering = dithering
+        # True when path_or_image is a dashboard image already drawn at the panel's resolution (Pillow renderer, composited static layer)
+        self._rasterized_dashboard = rasterized_dashboard
         self._image_file = self.load_image()
 
+    @property
+    def image(self):
+        return self._image_file
+
+    def is_svg(self):
+        # An SVG is either a filepath ending in .svg or the serialized SVG document itself (bytes)
+        if isinstance(self._path_or_image, bytes):
+            return True
+        return isinstance(self._path_or_image, str) and self._path_or_image.endswith(".svg")
+
+    def is_dashboard(self):
+        # Dashboards are already at the panel's resolution, photos still need to be cropped
+        return self._rasterized_dashboard or self.is_svg()
+
     def load_image(self):
-        if isinstance(self._path_or_image, str) and self._path_or_image.endswith(".svg"):
-            # Rasterize the SVG to PNG
-            png_image = cairosvg.svg2png(url=self._path_or_image, dpi=300)
-            # Convert PNG bytes data to Image object
-            img = Image.open(BytesIO(png_image))
-            
-            # Create a white background image
-            white_bg = Image.new("RGBA", img.size, "WHITE")
-            white_bg.paste(img, (0, 0), img)  # The last parameter is the alpha mask for transparency
-            return white_bg.convert("RGB")  # Convert to RGB to remove alpha channel
+        if self.is_svg():
+            # Rasterize the SVG to PNG directly at the panel's resolution, on a white background
+            img = rasterize_svg(self._path_or_image)
+
+            # Threshold to 1-bit on the server, the e-paper screen only displays black and white
+            return img.convert("1", dither=Image.Dither.NONE)
+        elif self._rasterized_dashboard and self._path_or_image.mode != "1":
+            # A grayscale dashboard is thresholded the same way as a rasterized SVG
+            return self._path_or_image.convert("1", dither=Image.Dither.NONE)
         else:
             # If it's an Image object or another format, return as it is.
             return self._path_or_image
@@ -27,11 +60,18 @@ class Image_transform:
     def render(self, height, width):
         # Resize image by height using a crop strategy 
         canvas = Image.new(mode="1", size=(width, height), color=(255))
-        image = ImageOps.exif_transpose(self._image_file)
+        image = self._image_file
+
+        # Decode JPEGs at the smallest DCT scale (1/2, 1/4 or 1/8) that is still taller than the frame, instead of at full size.
+        # Orientations 5 to 8 are rotated by exif_transpose, so their width becomes the height
+        orientation = image.getexif().get(ExifTags.Base.Orientation)
+        image.draft(image.mode, (height, 1) if orientation in (5, 6, 7, 8) else (1, height))
+        image = ImageOps.exif_transpose(image)
 
         hpercent = (height/float(image.size[1]))
         wsize = int((float(image.size[0])*float(hpercent)))
-        image = image.resize((wsize,height), Image.LANCZOS)
+        # reducing_gap shrinks the image with a fast box filter first, LANCZOS only runs on the last steps
+        image = image.resize((wsize,height), Image.LANCZOS, reducing_gap=3.0)
 
         # Center the image on the frame
         left = (image.size[0] - width) / 2
@@ -42,6 +82,9 @@ class Image_transform:
         # Crop the center of the image
         image = image.crop((left, top, right, bottom))
 
+        # Convert to black and white explicitly, instead of letting paste convert it
+        image = dither(image, self._dithering)
+
         # Paste image on canvas
         canvas.paste(image, (0, 0))
 
@@ -51,8 +94,50 @@ class Image_transform:
         """
         Save the rendered image to the specified output path or stream.
         """
-        if isinstance(self._path_or_image, str) and self._path_or_image.endswith(".svg"): #if we're dealing with an SVG filepath
+        if self.is_dashboard(): #if we're dealing with an SVG filepath, SVG bytes or a rasterized dashboard
             self._image_file.save(output_path_or_stream, format = "PNG")
         else:
             final_image = self.render(height=800, width=480) # if we're dealing with an image directly
             final_image.save(output_path_or_stream, format = "PNG")
+
+    def draw_battery_percentage(self, battery_percentage : str):
+        """
+        Overlay the battery percentage next to the battery icon, at the position used by the Pi.
+        """
+        font = ImageFont.truetype(FONT_PATH, 15)
+        draw = ImageDraw.Draw(self._image_file)
+        draw.text((90, 438), battery_percentage, font=font, fill=0, align='center')
+
+    @classmethod
+    def from_epd_buffer(cls, buffer : bytes):
+        """
+        Load a dashboard back from the raw framebuffer written by save_epd_buffer, e.g. to draw on a cached render.
+        """
+        image = Image.frombytes("1", (DASHBOARD_WIDTH, DASHBOARD_HEIGHT), buffer, "raw", "1;I")
+        return cls(path_or_image=image, rasterized_dashboard=True)
+
+    def save_epd_buffer(self, output_path_or_stream):
+        """
+        Save the image as the raw framebuffer expected by the 7.5 inch V2 panel (epd7in5_V2.EPD.display).
+
+        The image is rotated to landscape if needed and packed 8 pixels per byte with inverted bits,
+        because in the PIL world 0=black and 1=white, but in the e-paper world 0=white and 1=black.
+        This gives the exact output of EPD.getbuffer, so the Pi can send it to the screen as is.
+        """
+        if self.is_dashboard():
+            image = self._image_file
+        else:
+            image = self.render(height=800, width=480)
+
+        # Portrait images are rotated the same way EPD.getbuffer does
+        if image.size == (DASHBOARD_HEIGHT, DASHBOARD_WIDTH):
+            image = image.rotate(90, expand=True)
+
+        # "1;I" packs the pixels with inverted bits in a single pass
+        buffer = image.convert("1").tobytes("raw", "1;I")
+
+        if isinstance(output_path_or_stream, str):
+            with open(output_path_or_stream, "wb") as output_file:
+                output_file.write(buffer)
+        else:
+            output_path_or_stream.write(buffer)
@@ -0,0 +1,66 @@
+import os
+import hashlib
+import threading
+
+
+class FrameCache:
+    """
+    Keep Gmail photos on disk, keyed by (message_id, part_id), so a photo is downloaded and processed only once.
+
+    The attachment id is not part of the key: Gmail returns a different one each time the message is fetched.
+
+    Each photo can have two entries: "frame" (the processed 1-bit e-ink frame, as sent to the Pi) and "raw" (the attachment's bytes).
+    The least recently used entries are deleted when the cache grows over max_bytes.
+    """
+
+    def __init__(self, directory : str, max_bytes : int = 50 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, message_id : str, part_id : str, kind : str) -> str:
+        # Hash the key, so any message or part id makes a valid filename
+        name = hashlib.sha256(f"{message_id}/{part_id}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.{kind}")
+
+    def get(self, message_id : str, part_id : str, kind : str = "frame"):
+        # Return the cached bytes, or None if they are not cached
+        path = self.path(message_id, part_id, kind)
+        with self._lock:
+            try:
+                with open(path, "rb") as cached_file:
+                    data = cached_file.read()
+            except OSError:
+                return None
+            # The modification time tracks the last use of each entry
+            os.utime(path)
+            return data
+
+    def put(self, message_id : str, part_id : str, data : bytes, kind : str = "frame"):
+        # Store bytes, then delete the least recently used entries if the cache is too big
+        path = self.path(message_id, part_id, kind)
+        with self._lock:
+            try:
+                # Write to a temporary file first, so a crash never leaves a truncated entry behind
+                with open(path + ".tmp", "wb") as cached_file:
+                    cached_file.write(data)
+                os.replace(path + ".tmp", path)
+            except OSError as error:
+                print(f"Could not cache {path}: {error!r}")
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            os.remove(path)
+            total_size -= size
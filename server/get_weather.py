@@ -1,28 +1,181 @@
+import os
+import json
 import asyncio
 import datetime
 from typing import List, Dict, Tuple, Optional
 from env_canada import ECWeather, ECAirQuality
 import pytz
 import locale
+import functools
+import threading
+import time
+import concurrent.futures
 from timezonefinder import TimezoneFinder
 
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(coordinates: Tuple[float, float]) -> str:
+    """Get timezone string from coordinates, loading the timezone data only once per process"""
+    tf = TimezoneFinder()
+    timezone = tf.timezone_at(lat=coordinates[0], lng=coordinates[1])
+    if not timezone:
+        raise ValueError("Could not determine timezone from coordinates")
+    return timezone
+
+
+# Long-lived event loop running on a background thread, shared by every EC update of this process
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def run_on_event_loop(coroutine, timeout: Optional[float] = None):
+    """
+    Run a coroutine on the shared event loop and wait for its result, instead of starting a new loop with asyncio.run.
+
+    After timeout seconds the coroutine is cancelled, closing its connections, and concurrent.futures.TimeoutError is raised.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name="ec-event-loop", daemon=True).start()
+    future = asyncio.run_coroutine_threadsafe(coroutine, _event_loop)
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
 class GetEnviroCanWeather:   
-    def __init__(self, coordinates: Tuple[float, float], language='french', aq_language='FR'):
+    # Updated ECWeather/ECAirQuality pairs shared by every request of this process,
+    # keyed by (coordinates, language, aq_language): {key: (monotonic fetch time, unix fetch time, ec_weather, ec_air_quality)}
+    _cache = {}
+    _cache_lock = threading.Lock()
+    _refreshing = set()  # keys being refreshed in the background
+
+    # Resolved EC station and AQHI region of each coordinates, persisted so cold starts skip the site list downloads:
+    # {"lat,lon": {"station_id": ..., "site": {...}, "zone_id": ..., "region_id": ...}}
+    station_cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ec_stations.json")
+    _stations = None  # loaded from station_cache_path on first use
+    _stations_lock = threading.Lock()
+
+    def __init__(self, coordinates: Tuple[float, float], language='french', aq_language='FR', timezone: Optional[str] = None, cache_ttl: float = 600,
+                 max_stale: Optional[float] = None, timeout: Optional[float] = None):
         self.coordinates = coordinates
-        self.ec_weather = ECWeather(coordinates=coordinates, language=language)
-        self.ec_air_quality = ECAirQuality(coordinates=coordinates, language=aq_language)
+        self.language = language
+        self.aq_language = aq_language
+        self.cache_ttl = cache_ttl  # seconds before the cached EC data is refreshed in the background
+        self.max_stale = max_stale if max_stale is not None else 6 * cache_ttl  # seconds after which the cached EC data is no longer served
+        self.fetched_at = None  # unix time the EC data in use was fetched
+        self.timeout = timeout  # seconds before an update of the EC feeds is cancelled
+        self._cache_key = (tuple(coordinates), language, aq_language)
+        self._station_key = f"{coordinates[0]},{coordinates[1]}"  # other coordinates resolve their own station
+        self.ec_weather, self.ec_air_quality = self._make_ec_objects()
         locale.setlocale(locale.LC_TIME, 'fr_CA.UTF-8')
         
-        # Cache timezone
-        self._timezone = self._get_timezone()
+        # Timezone resolved once per process, unless given by the caller
+        self._timezone = timezone or get_timezone(tuple(coordinates))
+
+    @classmethod
+    def _load_stations(cls) -> Dict:
+        """Return the resolved stations, reading the local file only once per process"""
+        with cls._stations_lock:
+            if cls._stations is None:
+                try:
+                    with open(cls.station_cache_path) as stations_file:
+                        cls._stations = json.load(stations_file)
+                except (OSError, ValueError):
+                    cls._stations = {}
+            return cls._stations
+
+    def _make_ec_objects(self) -> Tuple[ECWeather, ECAirQuality]:
+        """Build the EC objects, from the resolved station and AQHI region when these coordinates were already resolved"""
+        station = self._load_stations().get(self._station_key)
+        if station is None:
+            return (ECWeather(coordinates=self.coordinates, language=self.language),
+                    ECAirQuality(coordinates=self.coordinates, language=self.aq_language))
 
-    async def _fetch_weather_data(self):
-        await self.ec_weather.update()
-        await self.ec_air_quality.update()
+        # With a station id, ECWeather still looks the station up in its site list: give it the station's row only
+        ec_weather = ECWeather(station_id=station["station_id"], language=self.language)
+        ec_weather.site_list = [station["site"]]
+        ec_air_quality = ECAirQuality(zone_id=station["zone_id"], region_id=station["region_id"], language=self.aq_language)
+        return ec_weather, ec_air_quality
+
+    def _save_station(self, ec_weather: ECWeather, ec_air_quality: ECAirQuality):
+        """Keep the station and AQHI region the EC objects resolved, in process and in the local file"""
+        stations = self._load_stations()
+        if self._station_key in stations or not ec_weather.station_tuple or not ec_air_quality.zone_id:
+            return
+
+        province_code, station_number = ec_weather.station_tuple
+        site = next((site for site in ec_weather.site_list
+                     if site["Codes"] == f"s0000{station_number.zfill(3)}" and site["Province Codes"] == province_code), None)
+        if site is None:
+            return
+
+        with self._stations_lock:
+            stations[self._station_key] = {
+                "station_id": ec_weather.station_id,
+                "site": {key: site[key] for key in ("Codes", "Province Codes", "Latitude", "Longitude")},
+                "zone_id": ec_air_quality.zone_id,
+                "region_id": ec_air_quality.region_id
+            }
+            try:
+                # Write to a temporary file first, so a crash never leaves a truncated file behind
+                temporary_path = self.station_cache_path + ".tmp"
+                with open(temporary_path, "w") as stations_file:
+                    json.dump(stations, stations_file, indent=2)
+                os.replace(temporary_path, self.station_cache_path)
+            except OSError as error:
+                print(f"Could not save the Environment Canada station to {self.station_cache_path}: {error!r}")
+
+    async def _fetch_weather_data(self, ec_weather: ECWeather, ec_air_quality: ECAirQuality):
+        # Both feeds are independent, fetch them at the same time
+        await asyncio.gather(ec_weather.update(), ec_air_quality.update())
+
+    def _update_cache(self, ec_weather: ECWeather, ec_air_quality: ECAirQuality):
+        # Fetch fresh data and share it with the next requests
+        run_on_event_loop(self._fetch_weather_data(ec_weather, ec_air_quality), timeout=self.timeout)
+        self._save_station(ec_weather, ec_air_quality)
+        with self._cache_lock:
+            self._cache[self._cache_key] = (time.monotonic(), time.time(), ec_weather, ec_air_quality)
+
+    def _refresh_in_background(self):
+        """Refresh the cached data on fresh EC objects, the expired ones keep being served until it is done"""
+        try:
+            self._update_cache(*self._make_ec_objects())
+        except Exception as error:
+            print(f"Environment Canada refresh failed, serving cached data: {error!r}")
+        finally:
+            with self._cache_lock:
+                self._refreshing.discard(self._cache_key)
+
+    def _load_cached_data(self):
+        """
+        Point the connector to cached EC data: fetched now if there is none, refreshed in the background once expired (stale-while-revalidate).
+
+        Data older than max_stale is fetched now too, so a failed fetch raises instead of serving it while EC is down.
+        """
+        with self._cache_lock:
+            cached = self._cache.get(self._cache_key)
+            age = time.monotonic() - cached[0] if cached is not None else None
+            if age is not None and age > self.max_stale:
+                print(f"Cached Environment Canada data is {age:.0f} s old, fetching it again")
+                cached = None
+            elif age is not None and age > self.cache_ttl and self._cache_key not in self._refreshing:
+                self._refreshing.add(self._cache_key)
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+        if cached is None:
+            self._update_cache(self.ec_weather, self.ec_air_quality)
+            self.fetched_at = time.time()
+        else:
+            _, self.fetched_at, self.ec_weather, self.ec_air_quality = cached
 
     def get_weather_data(self) -> Dict:
-        # Fetch fresh data
-        asyncio.run(self._fetch_weather_data())
+        # Use cached data when available, the EC feeds are updated far less often than the dashboard
+        self._load_cached_data()
         
         # Extract and format data
         current_weather = self._format_current_weather()
@@ -33,7 +186,8 @@ class GetEnviroCanWeather:
             "current": current_weather,
             "period_1": next_periods[0] if next_periods else {},
             "period_2": next_periods[1] if len(next_periods) > 1 else {},
-            "alerts": weather_alerts
+            "alerts": weather_alerts,
+            "fetched_at": self.fetched_at  # unix time, the data can be up to max_stale seconds old
         }
 
     def _safe_get(self, data: Dict, key: str, default="N/A"):
@@ -117,14 +271,6 @@ class GetEnviroCanWeather:
             "sunset": "N/A"
         }
 
-    def _get_timezone(self) -> str:
-        """Get timezone string from coordinates"""
-        tf = TimezoneFinder()
-        timezone = tf.timezone_at(lat=self.coordinates[0], lng=self.coordinates[1])
-        if not timezone:
-            raise ValueError("Could not determine timezone from coordinates")
-        return timezone
-
     def _get_formatted_date(self) -> str:
         """Get formatted current date and time"""
         try:
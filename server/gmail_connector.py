@@ -2,14 +2,47 @@
 
 from __future__ import print_function
 
-from googleapiclient.discovery import build
+from google_services import get_service
+from googleapiclient.errors import HttpError
 
+import os
+import json
 import base64
 import re
+import threading
+
+# Server-side filter of the fast scan: only messages with an image attachment
+IMAGE_ATTACHMENT_QUERY = "has:attachment (filename:jpg OR filename:jpeg OR filename:png OR filename:gif OR filename:bmp OR filename:webp)"
+
+# Partial response of the fast scan: only the parts' ids, names, types, attachment ids and text bodies
+MESSAGE_FIELDS = "id,payload/parts(partId,filename,mimeType,body(attachmentId,data),parts(mimeType,body/data))"
+
+# Partial response of the incremental sync: the ids and labels of the messages that changed
+HISTORY_FIELDS = ("history(messagesAdded/message(id,labelIds),messagesDeleted/message/id,"
+                  "labelsAdded(message(id,labelIds),labelIds),labelsRemoved(message(id,labelIds),labelIds)),historyId,nextPageToken")
+
+# The local index only holds messages in this label, both when it is rebuilt and when it is updated from the history
+INDEX_LABEL = "INBOX"
+
+# Messages with these labels are never shown, like in messages().list
+HIDDEN_LABELS = {"TRASH", "SPAM"}
+
+# Maximum number of requests in a batch HTTP request
+BATCH_SIZE = 100
+
+# Number of image attachments kept in the local index, most recent first
+INDEX_SIZE = 20
 
 # class that connects to Gmail and allows you to parse messages
 class GmailConnector():
 
+    # Local index of the most recent image attachments, updated incrementally from the last seen history id:
+    # {"history_id": ..., "attachments": [[message_id, attachment_id, body text, part_id], ...]}
+    # The attachment id is only valid for the download: Gmail changes it each time the message is fetched, the part id identifies the photo
+    attachment_index_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "gmail_index.json")
+    _index = None  # loaded from attachment_index_path on first use
+    _index_lock = threading.Lock()
+
     def __init__(self, creds):
         # creds are the credentials used to connect to the gmail API
         self.creds = creds
@@ -18,10 +51,14 @@ class GmailConnector():
         self.inbox_attachments = []
 
         # Build API call
-        self.service =  build('gmail', 'v1', credentials=self.creds)
+        self.service =  get_service('gmail', 'v1', self.creds)
 
-    def pull_attachments(self, userID, num_emails=10):
+    def pull_attachments(self, userID, num_emails=10, fast_scan=False):
         
+        # The fast scan only looks at messages with an image attachment, and stops at the first one
+        if fast_scan:
+            return self.scan_first_image(userID, num_emails)
+
         #List all emails
         results = self.service.users().messages().list(userId=userID).execute()
         
@@ -58,17 +95,202 @@ class GmailConnector():
                     att_id = parts['body']['attachmentId']
                 
                     # create a list of attachments
-                    self.inbox_attachments.append([message_id,att_id, data])
+                    self.inbox_attachments.append([message_id,att_id, data, parts['partId']])
+
+    def scan_first_image(self, userID, num_emails=10):
+        # List the most recent messages with an image attachment, ids only
+        results = self.service.users().messages().list(userId=userID, q=IMAGE_ATTACHMENT_QUERY, maxResults=num_emails,
+                                                       fields="messages/id").execute()
+        message_ids = [message['id'] for message in results.get('messages', [])]
+
+        # Keep the first image attachment, in the order of the list (most recent first)
+        self.inbox_attachments.extend(self.fetch_image_attachments(userID, message_ids, first_only=True))
+
+    def fetch_image_attachments(self, userID, message_ids, first_only=False, strict=False):
+        """
+        Return the [message_id, attachment_id, body text, part_id] of the first image attachment of each message, in the order of message_ids.
+
+        The messages are fetched with batch HTTP requests and a partial response. Messages without an image attachment are skipped.
+        A message that can't be fetched (e.g. 429 inside the batch) is skipped too, unless strict: its error is then raised.
+        """
+        messages = {}
+        errors = []
+        def store_message(request_id, response, exception):
+            if exception is not None:
+                print(f"Could not fetch message {request_id}: {exception}")
+                errors.append(exception)
+            else:
+                messages[request_id] = response
+
+        # Gmail accepts up to 100 requests per batch
+        for start in range(0, len(message_ids), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=store_message)
+            for message_id in message_ids[start:start + BATCH_SIZE]:
+                batch.add(self.service.users().messages().get(userId=userID, id=message_id, format='full', fields=MESSAGE_FIELDS),
+                          request_id=message_id)
+            batch.execute()
+
+        if strict and errors:
+            raise errors[0]
+
+        image_attachments = []
+        for message_id in message_ids:
+            parts = messages.get(message_id, {}).get('payload', {}).get('parts', [])
+            for parts_item in parts:
+                if 'attachmentId' in parts_item.get('body', {}) and parts_item.get('filename') and parts_item.get('mimeType', '').startswith('image/'):
+                    # Only the body text of the messages with an image is decoded
+                    image_attachments.append([message_id, parts_item['body']['attachmentId'], self.get_body_text(parts), parts_item['partId']])
+                    break
+            if first_only and image_attachments:
+                break
+        return image_attachments
+
+    def sync_attachments(self, userID, num_emails=10):
+        """
+        Fill inbox_attachments from the local index of image attachments, updated incrementally with the History API.
+
+        When no mail arrived since the last sync, this is a single history().list call.
+        The inbox is scanned again (num_emails messages with an image attachment) if there is no index yet or if the history expired.
+        """
+        with GmailConnector._index_lock:
+            index = self.load_index()
+            if index is not None:
+                try:
+                    self.update_index(userID, index)
+                except HttpError as error:
+                    # Gmail answers 404 when the history id is too old
+                    if error.resp.status != 404:
+                        # The index and its history id are left as they were, the same changes are listed again at the next sync
+                        print(f"Gmail sync failed, keeping the current index: {error}")
+                        self.inbox_attachments.extend(index["attachments"])
+                        return
+                    print("Gmail history expired, scanning the inbox again")
+                    index = None
+
+            if index is None:
+                index = self.rebuild_index(userID, num_emails)
+            self.save_index(index)
+
+            self.inbox_attachments.extend(index["attachments"])
+
+    def rebuild_index(self, userID, num_emails):
+        # Get the history id first, so the messages arriving during the scan are in the next update
+        history_id = self.service.users().getProfile(userId=userID, fields="historyId").execute()['historyId']
+        results = self.service.users().messages().list(userId=userID, q=IMAGE_ATTACHMENT_QUERY, labelIds=[INDEX_LABEL],
+                                                       maxResults=num_emails, fields="messages/id").execute()
+        message_ids = [message['id'] for message in results.get('messages', [])]
+        # A message missing from the scan would never be listed again: fail instead, the inbox is scanned again at the next sync
+        return {"history_id": history_id, "attachments": self.fetch_image_attachments(userID, message_ids, strict=True)[:INDEX_SIZE]}
+
+    def update_index(self, userID, index):
+        # List what changed since the last sync, ids and labels only
+        # Each change is filtered on the message's labels rather than with labelId, so a message leaving the inbox for the trash is still seen
+        in_frame = {}  # {message_id: whether the message can be shown}, in the order of its last change
+        history_id = index["history_id"]
+        page_token = None
+        while True:
+            results = self.service.users().history().list(userId=userID, startHistoryId=index["history_id"], pageToken=page_token,
+                                                           historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+                                                           fields=HISTORY_FIELDS).execute()
+            for history in results.get('history', []):
+                changes = [(change['message'], self.is_shown(change['message'])) for change in history.get('messagesAdded', [])]
+                changes += [(change['message'], False) for change in history.get('messagesDeleted', [])]
+                for change in history.get('labelsAdded', []):
+                    # Moved to the trash or the spam, or back to the inbox
+                    if HIDDEN_LABELS.intersection(change.get('labelIds', [])):
+                        changes.append((change['message'], False))
+                    elif INDEX_LABEL in change.get('labelIds', []):
+                        changes.append((change['message'], self.is_shown(change['message'])))
+                for change in history.get('labelsRemoved', []):
+                    # Archived, or restored from the trash or the spam
+                    if INDEX_LABEL in change.get('labelIds', []) or HIDDEN_LABELS.intersection(change.get('labelIds', [])):
+                        changes.append((change['message'], self.is_shown(change['message'])))
+
+                for message, shown in changes:
+                    in_frame.pop(message['id'], None)
+                    in_frame[message['id']] = shown
+            history_id = results.get('historyId', history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        # The history is in chronological order, the index is most recent first
+        new_message_ids = [message_id for message_id, shown in reversed(in_frame.items()) if shown]
+        # Raises if a message can't be fetched, before the history id moves past it
+        new_attachments = self.fetch_image_attachments(userID, new_message_ids, strict=True) if new_message_ids else []
+        kept_attachments = [attachment for attachment in index["attachments"] if attachment[0] not in in_frame]
+
+        # A message can be listed twice, e.g. when it arrived during the scan of rebuild_index
+        attachments, seen = [], set()
+        for attachment in new_attachments + kept_attachments:
+            if attachment[0] not in seen:
+                seen.add(attachment[0])
+                attachments.append(attachment)
+
+        index["attachments"] = attachments[:INDEX_SIZE]
+        index["history_id"] = history_id
+
+    @staticmethod
+    def is_shown(message):
+        # Same messages as rebuild_index: in the inbox, not in the trash or the spam
+        labels = set(message.get('labelIds', []))
+        return INDEX_LABEL in labels and not HIDDEN_LABELS.intersection(labels)
+
+    @classmethod
+    def load_index(cls):
+        # Return the attachment index, reading the local file only once per process (None if there is none yet)
+        if cls._index is None:
+            try:
+                with open(cls.attachment_index_path) as index_file:
+                    index = json.load(index_file)
+            except (OSError, ValueError):
+                return None
+            # An index saved before the part ids were kept is scanned again
+            if any(len(attachment) < 4 for attachment in index.get("attachments", [])):
+                return None
+            cls._index = index
+        return cls._index
+
+    @classmethod
+    def save_index(cls, index):
+        cls._index = index
+        try:
+            # Write to a temporary file first, so a crash never leaves a truncated file behind
+            temporary_path = cls.attachment_index_path + ".tmp"
+            with open(temporary_path, "w") as index_file:
+                json.dump(index, index_file, indent=2)
+            os.replace(temporary_path, cls.attachment_index_path)
+        except OSError as error:
+            print(f"Could not save the attachment index to {cls.attachment_index_path}: {error!r}")
+
+    def get_body_text(self, parts):
+        # Same text as pull_attachments: the text/plain part, or the first sub-part of a multipart part
+        data = ""
+        for parts_item in parts:
+            if "parts" in parts_item:
+                body = parts_item["parts"][0]["body"].get("data")
+            elif parts_item.get('mimeType') == 'text/plain':
+                body = parts_item.get("body", {}).get("data")
+            else:
+                continue
+
+            if body:
+                data = base64.urlsafe_b64decode(body.encode("ASCII")).decode("utf-8").replace('\r\n', '')
+                #remove text between brackets
+                data = re.sub(r'\[.*?\]', ' ', data)
+        return data
                    
+    def download_attachment(self, userID, message_id, attachment_id):
+        # Return the decoded bytes of an attachment
+        img_data = self.service.users().messages().attachments().get(userId=userID, messageId=message_id, id=attachment_id).execute()
+        img_data=img_data['data'].encode('UTF-8')
+        return base64.urlsafe_b64decode(img_data)
+
     def grab_first_image(self, userID):
         #get first available attachment
-        img_data = self.service.users().messages().attachments().get(userId=userID, messageId=self.inbox_attachments[0][0],id=self.inbox_attachments[0][1]).execute()
-        img_data=img_data['data'].encode('UTF-8')
+        file_data=self.download_attachment(userID, self.inbox_attachments[0][0], self.inbox_attachments[0][1])
         output_text=self.inbox_attachments[0][2]
         
-        #decode string
-        file_data=base64.urlsafe_b64decode(img_data)
-        
         #open as an image
         import io
         from PIL import Image
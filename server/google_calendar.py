@@ -2,17 +2,17 @@
 
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
-from googleapiclient.discovery import build
+from google_services import get_service
 from googleapiclient.errors import HttpError
 from dateutil import parser
 
 class GCalConnector:
     """Connector for Google Calendar API to fetch calendar events."""
 
-    def __init__(self, creds, local_timezone_str, calendar_id: str):
-        """Initialize the connector with Google credentials."""
+    def __init__(self, creds, local_timezone_str, calendar_id: str, timeout: float = 60):
+        """Initialize the connector with Google credentials. Each socket operation gives up after timeout seconds."""
         self.creds = creds
-        self.service = build('calendar', 'v3', credentials=creds)
+        self.service = get_service('calendar', 'v3', creds, timeout=timeout)
         self.calendar_id = calendar_id
         self.now_utc = datetime.now(timezone.utc) # Timezone-aware current time in UTC
         self.local_timezone = ZoneInfo(local_timezone_str) # Get current timezone from string
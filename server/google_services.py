@@ -0,0 +1,35 @@
+import threading
+
+import google_auth_httplib2
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http, DEFAULT_HTTP_TIMEOUT_SEC
+
+# Google API clients of each thread: httplib2 connections can't be shared between threads,
+# but each thread keeps its clients (and their open connections) from one request to the next
+_thread_services = threading.local()
+
+
+def get_service(api_name : str, api_version : str, credentials, timeout : float = DEFAULT_HTTP_TIMEOUT_SEC):
+    """
+    Return the Google API client for these credentials, building it only once per thread.
+
+    The client is built from the discovery document bundled with google-api-python-client, without any network call.
+    It is built again when the credentials change (the credential store keeps the same object across refreshes).
+    Every socket operation of the client gives up after timeout seconds, so a stalled connection can't block its thread forever.
+    """
+    services = getattr(_thread_services, "services", None)
+    if services is None:
+        services = _thread_services.services = {}
+
+    cached = services.get((api_name, api_version))
+    if cached is not None and cached[0] is credentials and cached[1] == timeout:
+        return cached[2]
+
+    # The authorized transport reuses its connections and refreshes the token on a 401
+    # build_http is what build() uses without a transport: same redirect handling, with a timeout
+    http = build_http()
+    http.timeout = timeout
+    service = build(api_name, api_version, http=google_auth_httplib2.AuthorizedHttp(credentials, http=http),
+                    static_discovery=True, cache_discovery=False)
+    services[(api_name, api_version)] = (credentials, timeout, service)
+    return service
@@ -2,7 +2,7 @@
 
 from __future__ import print_function
 
-from googleapiclient.discovery import build
+from google_services import get_service
 
 import base64
 import re
@@ -10,13 +10,13 @@ import re
 # class that connects to Gmail and allows you to parse messages
 class GtasksConnector():
 
-    def __init__(self, creds):
+    def __init__(self, creds, timeout=60):
         # creds are the credentials used to connect to the Google Tasks API
         self.creds = creds
         self.task_list_ids = []
 
-        # Build API call
-        self.service =  build('tasks', 'v1', credentials=self.creds)
+        # Build API call, each socket operation gives up after timeout seconds
+        self.service =  get_service('tasks', 'v1', self.creds, timeout=timeout)
         
     def get_lists(self):
         # Call the Tasks API
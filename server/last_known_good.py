@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import threading
+
+
+class LastKnownGood:
+    """
+    Keep the last successful payload of each data source on disk, so a failing source can still be drawn from its previous data.
+
+    Payloads are kept as json: each call to get returns a fresh copy that can be modified.
+    """
+
+    def __init__(self, path : str):
+        self.path = path
+        self._payloads = None  # {source name: {"fetched_at": unix time, "payload": json}}, read from disk on first use
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._payloads is None:
+            try:
+                with open(self.path) as payloads_file:
+                    self._payloads = {name: {"fetched_at": entry["fetched_at"], "payload": json.dumps(entry["payload"])}
+                                      for name, entry in json.load(payloads_file).items()}
+            except (OSError, ValueError, KeyError, AttributeError):
+                self._payloads = {}
+        return self._payloads
+
+    def get(self, name : str):
+        """Return (fetched_at, payload) of the last successful fetch of the source, or None if there is none."""
+        with self._lock:
+            entry = self._load().get(name)
+        if entry is None:
+            return None
+        return entry["fetched_at"], json.loads(entry["payload"])
+
+    def put(self, name : str, payload, fetched_at : float = None):
+        """
+        Keep the payload of a successful fetch, fetched at the given unix time (now by default).
+
+        The file is only written when the payload changed: after a restart, an unchanged payload keeps the time it was first fetched.
+        """
+        # Only json payloads are kept (not e.g. the redirect to the authorization flow)
+        try:
+            serialized = json.dumps(payload)
+        except (TypeError, ValueError):
+            return
+
+        with self._lock:
+            payloads = self._load()
+            unchanged = payloads.get(name, {}).get("payload") == serialized
+            payloads[name] = {"fetched_at": fetched_at or time.time(), "payload": serialized}
+            if unchanged:
+                return
+
+            try:
+                # Write to a temporary file first, so a crash never leaves a truncated file behind
+                temporary_path = self.path + ".tmp"
+                with open(temporary_path, "w") as payloads_file:
+                    json.dump({name: {"fetched_at": entry["fetched_at"], "payload": json.loads(entry["payload"])}
+                               for name, entry in payloads.items()}, payloads_file, indent=2, ensure_ascii=False)
+                os.replace(temporary_path, self.path)
+            except OSError as error:
+                print(f"Could not save the last known good data to {self.path}: {error!r}")
@@ -10,9 +10,14 @@ from flask import send_file
 import requests
 import json
 from io import BytesIO
+from PIL import Image
 from itertools import islice
 from dotenv import load_dotenv
 import ast
+import time
+import datetime
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
 
 #google libraries
 import google_auth_oauthlib.flow
@@ -26,8 +31,17 @@ from gmail_connector import GmailConnector
 from google_calendar import GCalConnector
 from eink_image import Image_transform
 from svg_updater import SVGFile
-from get_weather import GetEnviroCanWeather
+from get_weather import GetEnviroCanWeather, get_timezone
 from google_tasks import GtasksConnector
+from render_cache import RenderCache
+from credential_store import CredentialStore
+from frame_cache import FrameCache
+from render_plan import PlannedSVGFile
+from pillow_renderer import PillowSVGFile
+from prefetch_scheduler import PrefetchScheduler
+from single_flight import SingleFlight
+from circuit_breaker import CircuitBreaker
+from last_known_good import LastKnownGood
 
 # Get the absolute path of the directory of the current script
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -39,8 +53,25 @@ load_dotenv()
 CLIENT_SECRETS_FILE = os.getenv("CLIENT_SECRETS_FILE")
 FLASK_KEY = os.getenv("FLASK_KEY")
 WEATHER_COORDINATES = ast.literal_eval(os.getenv("WEATHER_COORDINATES"))
+GMAIL_INCREMENTAL_SYNC = os.getenv("GMAIL_INCREMENTAL_SYNC", "true").lower() == "true" # keep a local index of image attachments, updated from the Gmail history
+GMAIL_CACHE_DIR = os.getenv("GMAIL_CACHE_DIR") or os.path.join(dir_path, "gmail_cache") # processed photos, so each one is downloaded and resized once
+GMAIL_CACHE_MAX_MB = float(os.getenv("GMAIL_CACHE_MAX_MB", "50"))
+GMAIL_CACHE_RAW = os.getenv("GMAIL_CACHE_RAW", "false").lower() == "true" # also keep the original attachments
+PHOTO_DITHERING = os.getenv("PHOTO_DITHERING", "floyd-steinberg") # threshold, bayer, floyd-steinberg or atkinson
+GMAIL_FAST_SCAN = os.getenv("GMAIL_FAST_SCAN", "true").lower() == "true" # only fetch messages with an image attachment, in one batch request
+# Timezone of the weather coordinates, shared by the weather and calendar connectors. Resolved once at startup if not set
+LOCAL_TIMEZONE = os.getenv("LOCAL_TIMEZONE") or get_timezone(WEATHER_COORDINATES)
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600")) # seconds before the Environment Canada data is refreshed in the background
+WEATHER_MAX_STALE = float(os.getenv("WEATHER_MAX_STALE", str(6 * WEATHER_CACHE_TTL))) # seconds before the cached data is no longer served while EC is down
 GOOGLE_CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID")
 GOOGLE_TASKS_LIST_ID = os.getenv("GOOGLE_TASKS_LIST_ID")
+SVG_DEBUG_OUTPUT = os.getenv("SVG_DEBUG_OUTPUT") # optional path where the updated SVG is written for debugging
+USE_RENDER_PLAN = os.getenv("USE_RENDER_PLAN", "false").lower() == "true" # fill the compiled template instead of modifying an lxml tree
+USE_STATIC_LAYER = os.getenv("USE_STATIC_LAYER", "false").lower() == "true" # rasterize the frames and fixed icons once per process
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "cairosvg").lower() # "cairosvg" rasterizes the SVG, "pillow" draws the fixed layout with Pillow
+WAKE_SCHEDULE = os.getenv("WAKE_SCHEDULE", "06:01,18:01") # local times the Pi wakes up (see screen/alarm.sh), empty to disable the prefetch
+PREFETCH_LEAD_MINUTES = float(os.getenv("PREFETCH_LEAD_MINUTES", "3")) # the dashboard is fetched and rendered this long before each wake
+PREFETCH_MAX_AGE = float(os.getenv("PREFETCH_MAX_AGE", "900")) # seconds the prefetched data is served instead of fetching the sources again
 
 # Fetch tokens for Google services from .env file
 TOKEN_GMAIL = os.getenv("TOKEN_GMAIL")
@@ -52,13 +83,49 @@ SCOPES_GMAIL = os.getenv('SCOPES_GMAIL').split(',')
 SCOPES_GTASKS = os.getenv('SCOPES_GTASKS').split(',')
 SCOPES_GCALENDAR = os.getenv('SCOPES_GCALENDAR').split(',')
 
+# Timeout of each data source of the dashboard, in seconds. The sources are fetched concurrently
+# Each connector also gets its timeout (sockets of the Google clients, whole update of the EC feeds), so a stalled call frees its thread
+SOURCE_TIMEOUTS = {"weather": float(os.getenv("WEATHER_TIMEOUT", "20")),
+                   "grocery": float(os.getenv("GROCERY_TIMEOUT", "10")),
+                   "calendar": float(os.getenv("CALENDAR_TIMEOUT", "10"))}
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3")) # failures in a row before a source is no longer called
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "300")) # seconds before a failing source is tried again
+LAST_KNOWN_GOOD_PATH = os.getenv("LAST_KNOWN_GOOD_PATH") or os.path.join(dir_path, "last_known_good.json") # last successful data of each source
+
+# Dashboard template
+TEMPLATE_SVG_PATH = os.path.join(dir_path, "svg_template.svg")
+
 ## FLASK APP
 app = flask.Flask(__name__)
 app.secret_key= FLASK_KEY
 
+# Recent dashboard renders, keyed by a hash of their data (also used as ETag)
+render_cache = RenderCache(max_entries=8)
+
+# Gmail photos already processed for the e-ink screen, on disk
+frame_cache = FrameCache(GMAIL_CACHE_DIR, max_bytes=int(GMAIL_CACHE_MAX_MB * 1024 * 1024))
+
+# Google credentials of each service, refreshed in the background so the Pi's requests never wait on the token endpoint
+credential_store = CredentialStore()
+
+# Threads fetching the dashboard's data sources, shared by every request so the number of outgoing calls stays bounded
+source_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SOURCE_POOL_SIZE", "8")), thread_name_prefix="source")
+
+# Output formats rendered before each wake of the Pi, without the battery percentage (added when sending the framebuffer)
+# The Pi fetches the framebuffer by default (see screen/display.py), other formats are added when they are requested
+prefetch_formats = {"framebuffer"}
+
+# Concurrent requests share the fetch of each source and the render of each dashboard in flight instead of repeating them
+single_flight = SingleFlight()
+
+# A source failing again and again is not called until its circuit closes, its last known good data is drawn instead
+circuit_breakers = {name: CircuitBreaker(name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT)
+                    for name in SOURCE_TIMEOUTS}
+last_known_good = LastKnownGood(LAST_KNOWN_GOOD_PATH)
+
 ## FUNCTIONS
 
-def refresh_token(token_name : str, from_session : bool):
+def refresh_token(token_name : str, from_session : bool, service_name : str):
 
   if from_session:
     credentials = Credentials.from_authorized_user_info(
@@ -71,7 +138,7 @@ def refresh_token(token_name : str, from_session : bool):
   )
 
   if not credentials.valid:
-    print(f"{flask.session['service_name']} credentials not valid, refreshing")
+    print(f"{service_name} credentials not valid, refreshing")
 
     credentials.refresh(Request())
 
@@ -80,22 +147,22 @@ def refresh_token(token_name : str, from_session : bool):
 
   return credentials
 
-def auth_flow():
+def auth_flow(service_name : str = None):
 
-  token_name = flask.session['service_name']+'_TOKEN'
-  token_from_env = os.getenv(flask.session['service_name']+'_TOKEN')
+  # The service name is passed explicitly when sources are fetched concurrently, they share the same session
+  service_name = service_name or flask.session['service_name']
+  token_name = service_name+'_TOKEN'
+  token_from_env = os.getenv(service_name+'_TOKEN')
 
   # first check if we have a credential stored in the flask session
   if token_name in flask.session:
     print(f"{token_name} found in session")
-    credentials = refresh_token(token_name = token_name, from_session = True)
+    credentials = refresh_token(token_name = token_name, from_session = True, service_name = service_name)
     return credentials
 
-  # otherwise check if we have anything in the env file
+  # otherwise check if we have anything in the env file, kept in memory and refreshed by the credential store
   elif token_from_env:
-    print(f"{token_name} found in env")
-
-    credentials = refresh_token(token_name=token_name, from_session = False)
+    credentials = credential_store.get(service_name, token_from_env)
     return credentials
 
    # otherwise generate credentials from scratch
@@ -126,14 +193,14 @@ def fetch_grocery_list():
     flask.session['service_name'] = 'GTASKS'
     flask.session['scopes'] = SCOPES_GTASKS
     
-    credentials = auth_flow()
+    credentials = auth_flow('GTASKS')
 
     # If credentials are None, we need to generated them
     if not credentials:
       return flask.redirect('authorize')
     
     else:   
-      Google_tasks = GtasksConnector(creds=credentials) # Connect to service 
+      Google_tasks = GtasksConnector(creds=credentials, timeout=SOURCE_TIMEOUTS["grocery"]) # Connect to service 
       # Google_tasks.get_lists() # Run to see the available task lists in your account
       grocery_items = Google_tasks.get_tasks(tasklist_id=GOOGLE_TASKS_LIST_ID) # Fetch a specific task list
       
@@ -154,42 +221,56 @@ def fetch_image_from_gmail():
     gmail_inbox =  GmailConnector(creds=credentials)
 
     # pull attachments (num_emails looks at the X most recent emails to be sure we intercept an attachment)
-    gmail_inbox.pull_attachments(userID='me', num_emails=3)
-
-    # get the image to send
-    image_to_send, output_text = gmail_inbox.grab_first_image(userID = 'me')
-  
-    # prepare bytes stream
-    output_stream = BytesIO()
-    #transform image into a low res format for the eink screen
-    transformed_image = Image_transform(path_or_image=image_to_send)
-    transformed_image.save(output_path_or_stream = output_stream)
-      
-    # display the image (don't cache it)
-    # output.seek resets the pointer to the beginning of the file 
-    output_stream.seek(0)
-    
-    return send_file(output_stream, mimetype="image/png")
+    # the fast scan filters messages with an image attachment on Gmail's side, so num_emails candidates are all relevant
+    # the incremental sync only asks Gmail what changed since the last request
+    if GMAIL_INCREMENTAL_SYNC:
+      gmail_inbox.sync_attachments(userID='me', num_emails=3)
+    else:
+      gmail_inbox.pull_attachments(userID='me', num_emails=3, fast_scan=GMAIL_FAST_SCAN)
+
+    # the same photo is only downloaded, decoded and resized once
+    # it is cached by message and part: the attachment id changes each time the message is fetched, it is only used for the download
+    message_id, attachment_id, _, part_id = gmail_inbox.inbox_attachments[0]
+    frame = frame_cache.get(message_id, part_id, kind=f"frame-{PHOTO_DITHERING}")
+
+    if frame is None:
+      # get the image to send, from the cached original if there is one
+      file_data = frame_cache.get(message_id, part_id, kind="raw")
+      if file_data is None:
+        file_data = gmail_inbox.download_attachment('me', message_id, attachment_id)
+        if GMAIL_CACHE_RAW:
+          frame_cache.put(message_id, part_id, file_data, kind="raw")
+      image_to_send = Image.open(BytesIO(file_data))
+
+      # prepare bytes stream
+      output_stream = BytesIO()
+      #transform image into a low res format for the eink screen
+      transformed_image = Image_transform(path_or_image=image_to_send, dithering=PHOTO_DITHERING)
+      transformed_image.save(output_path_or_stream = output_stream)
+
+      frame = output_stream.getvalue()
+      frame_cache.put(message_id, part_id, frame, kind=f"frame-{PHOTO_DITHERING}")
+
+    # display the image (don't cache it in the browser)
+    return send_file(BytesIO(frame), mimetype="image/png")
 
 def fetch_weather():
-  weather_service = GetEnviroCanWeather(WEATHER_COORDINATES)
+  weather_service = GetEnviroCanWeather(WEATHER_COORDINATES, timezone=LOCAL_TIMEZONE, cache_ttl=WEATHER_CACHE_TTL, max_stale=WEATHER_MAX_STALE,
+                                         timeout=SOURCE_TIMEOUTS["weather"])
   return weather_service.get_weather_data()
 
 def fetch_calendar_events():
   flask.session['service_name'] = 'GCALENDAR'
   flask.session['scopes'] = SCOPES_GCALENDAR
   
-  credentials = auth_flow()
+  credentials = auth_flow('GCALENDAR')
   
   # If credentials are None, we need to generated them
   if not credentials:
     return flask.redirect('authorize')
 
   else:   
-    weather_service = GetEnviroCanWeather(WEATHER_COORDINATES)   # Get local timezone from weather service
-    local_timezone_str = weather_service._timezone 
-
-    google_calendar = GCalConnector(creds = credentials, local_timezone_str= local_timezone_str, calendar_id=GOOGLE_CALENDAR_ID)
+    google_calendar = GCalConnector(creds = credentials, local_timezone_str= LOCAL_TIMEZONE, calendar_id=GOOGLE_CALENDAR_ID, timeout=SOURCE_TIMEOUTS["calendar"])
     #google_calendar.get_calendars_list() # Run to print the available calendars in your account
 
     return google_calendar.get_calendar_events()
@@ -212,6 +293,7 @@ def index():
     "<tr><td><a href='/weather_output'>Test the weather output (no API required)</a></td></tr>" +                
     "<tr><td colspan='2'><hr></td></tr>" +
     "<tr><td><b><a href='/dashboard_homepage'>See dashboard homepage</a></b></td></tr>" +    
+    "<tr><td><a href='/dashboard_framebuffer'>Download the dashboard as a raw e-paper framebuffer</a></td></tr>" +
     "<tr><td colspan='2'><hr></td></tr>" +
     "<tr><td><a href='/authorize'>Test the auth flow (Gmail by default). You will be sent back to the index</a></td></tr>" +
     "<tr><td><a href='/revoke_gmail'>Revoke the credentials for Gmail</a></td></tr>" +
@@ -234,33 +316,250 @@ def weather_output():
     weather_data = fetch_weather()
     return f'{weather_data}'
 
-# display dashboard homepage
-@app.route('/dashboard_homepage')
-def draw_homepage():
+def fetch_sources_concurrently(sources : dict, fallbacks : dict) -> dict:
+    """
+    Fetch the data sources at the same time on the shared thread pool, so the slowest one sets the latency instead of their sum.
+
+    Parameters:
+    - sources (dict): The function fetching each source, by name.
+    - fallbacks (dict): The value used for a source that fails, exceeds its timeout or has its circuit open,
+      when it has no last known good data. Sources without either raise instead.
+
+    The timings of each source are printed and stored in flask.g.source_timings (sent as a Server-Timing header).
+    The sources drawn from their last known good data are stored in flask.g.stale_sources, with the time of that data.
+    The sources record their own outcome in their circuit breaker and last known good data (see record_outcome).
+    """
+    start = time.perf_counter()
+    timings = {}
+
+    def timed(name, fetch):
+        # Each source runs with a copy of the request context, since the Google sources use the session
+        @flask.copy_current_request_context
+        def run():
+            source_start = time.perf_counter()
+            try:
+                return fetch()
+            finally:
+                timings[name] = (time.perf_counter() - source_start) * 1000
+        return run
+
+    # Sources with an open circuit are not called at all
+    futures = {}
+    for name, fetch in sources.items():
+        if circuit_breakers[name].allow():
+            futures[name] = source_pool.submit(timed(name, fetch))
+        else:
+            timings[name] = 0
+            print(f"{name} circuit open, not calling it")
+
+    results = {}
+    flask.g.stale_sources = {}
+    for name in sources:
+        error = RuntimeError(f"{name} circuit is open")
+        if name in futures:
+            # Every timeout counts from the same start, a slow source doesn't delay the deadline of the others
+            remaining = SOURCE_TIMEOUTS[name] - (time.perf_counter() - start)
+            try:
+                results[name] = futures[name].result(timeout=max(remaining, 0))
+                continue
+            except Exception as source_error:
+                error = source_error
+                # The source's own errors can be timeouts too: only a future still running timed out here
+                if not futures[name].done():
+                    timings[name] = SOURCE_TIMEOUTS[name] * 1000
+                    print(f"{name} timed out after {SOURCE_TIMEOUTS[name]} s")
+                else:
+                    print(f"{name} failed: {error!r}")
+
+        # Draw the last data fetched successfully, from a previous request or before a restart
+        known = last_known_good.get(name)
+        if known is not None:
+            flask.g.stale_sources[name], results[name] = known
+            print(f"{name} drawn from its last known good data")
+        elif name in fallbacks:
+            results[name] = fallbacks[name]
+        else:
+            raise error
+
+    flask.g.source_timings = {name: timings[name] for name in sources}
+    print("Sources fetched in " + ", ".join(f"{name}: {duration:.0f} ms" for name, duration in flask.g.source_timings.items())
+          + f" (total {(time.perf_counter() - start) * 1000:.0f} ms)")
+    return results
+
+def record_outcome(name : str, fetch):
+    """
+    Return a function calling fetch and recording its outcome: in the source's circuit breaker, and in the last known good data if it succeeded.
+
+    It runs inside the single flight, so a fetch shared by concurrent requests is recorded once.
+    The outcome is recorded when the fetch ends, even after every request stopped waiting for it:
+    a fetch that took longer than the source's timeout counts as a failure, but its data is still kept.
+    """
+    def run():
+        start = time.perf_counter()
+        try:
+            result = fetch()
+        except Exception:
+            circuit_breakers[name].record_failure()
+            raise
+
+        if time.perf_counter() - start > SOURCE_TIMEOUTS[name]:
+            circuit_breakers[name].record_failure()
+        else:
+            circuit_breakers[name].record_success()
+        # Sources serving cached data tell when it was fetched (the weather)
+        fetched_at = result.get("fetched_at") if isinstance(result, dict) else None
+        last_known_good.put(name, result, fetched_at=fetched_at)
+        return result
+    return run
+
+def mark_stale_sources(sources : dict, stale_sources : dict):
+    # Show the time of the data drawn from a source that is unavailable: in place of the date for the weather, as a first line for the lists
+    for name, fetched_at in stale_sources.items():
+        fetched_at = datetime.datetime.fromtimestamp(fetched_at, ZoneInfo(LOCAL_TIMEZONE))
+        if name == "weather":
+            sources[name]["current"]["current_date"] = f"Météo au {fetched_at:%d/%m %H:%M}"
+        else:
+            sources[name] = [f"(au {fetched_at:%d/%m %H:%M})"] + sources[name]
+
+def fetch_dashboard_data():
+    # Fetch the weather, grocery list and calendar events concurrently
+    # An unavailable source is drawn from its last known good data, marked with its time
+    # Without any, an empty list is shown for the grocery list or the calendar, but the dashboard can't be drawn without the weather
+    sources = fetch_sources_concurrently(
+        # A request joining a fetch in flight stops waiting at the source's timeout, like the one that started it
+        sources={name: single_flight.wrap(name, record_outcome(name, fetch), timeout=SOURCE_TIMEOUTS[name])
+                 for name, fetch in (("weather", fetch_weather), ("grocery", fetch_grocery_list), ("calendar", fetch_calendar_events))},
+        fallbacks={"grocery": [], "calendar": []})
+
+    mark_stale_sources(sources, flask.g.stale_sources)
+
     # Get weather data as a dictionary
-    weather_data = fetch_weather()
+    weather_data = sources["weather"]
     current_weather_dict = weather_data["current"]
     forecast_period_1_dict = weather_data["period_1"]
     forecast_period_2_dict = weather_data["period_2"]
     alerts = weather_data["alerts"]
 
     # Get grocery list
-    grocery_items = {"grocery_list": fetch_grocery_list()}
+    grocery_items = {"grocery_list": sources["grocery"]}
 
     # Get calendar items
-    calendar_items = {"calendar_events": fetch_calendar_events()}
-
-    final_svg = SVGFile(template_svg_filepath=os.path.join(dir_path, "svg_template.svg"), 
-                       output_filename=os.path.join(dir_path, "svg_output.svg"))
-    
-    final_svg.update_svg(current_weather_dict=current_weather_dict, 
-                        forecast_period_1_dict=forecast_period_1_dict, 
-                        forecast_period_2_dict=forecast_period_2_dict, 
-                        grocery_dict=grocery_items, 
-                        calendar_dict=calendar_items)
-    output = final_svg.send_to_pi()
+    calendar_items = {"calendar_events": sources["calendar"]}
+
+    # Return the arguments of SVGFile.update_svg
+    return {"current_weather_dict": current_weather_dict,
+            "forecast_period_1_dict": forecast_period_1_dict,
+            "forecast_period_2_dict": forecast_period_2_dict,
+            "grocery_dict": grocery_items,
+            "calendar_dict": calendar_items}
+
+def render_dashboard(dashboard_data : dict, output_format : str) -> bytes:
+    # The SVG is rendered in memory. Set SVG_DEBUG_OUTPUT to also write the updated SVG to disk
+    # Both classes give byte-identical SVGs, the render plan just joins pre-serialized bytes
+    svg_class = PlannedSVGFile if USE_RENDER_PLAN else SVGFile
+    # The Pillow backend draws the layout without cairo, its output is close to but not the same as cairo's
+    if RENDER_BACKEND == "pillow":
+        svg_class = PillowSVGFile
+    final_svg = svg_class(template_svg_filepath=TEMPLATE_SVG_PATH, 
+                       output_filename=SVG_DEBUG_OUTPUT)
     
-    return send_file(output, mimetype="image/png")
+    final_svg.update_svg(**dashboard_data)
+
+    # The framebuffer is rendered without the battery percentage, it is added when sending it
+    if output_format == "framebuffer":
+        output = final_svg.send_framebuffer_to_pi(use_static_layer=USE_STATIC_LAYER)
+    else:
+        output = final_svg.send_to_pi(use_static_layer=USE_STATIC_LAYER)
+
+    return output.getvalue()
+
+def render_key(dashboard_data : dict, output_format : str) -> str:
+    # A hash of everything the render depends on, including the template version
+    return RenderCache.make_key(dashboard_data, output_format, RENDER_BACKEND, os.path.getmtime(TEMPLATE_SVG_PATH))
+
+def get_or_render_dashboard(key : str, dashboard_data : dict, output_format : str) -> bytes:
+    # Only render the dashboard if the same data hasn't been rendered already, or isn't being rendered by another request
+    output = render_cache.get(key)
+    if output is None:
+        output = single_flight.do(f"render {key}", lambda: render_and_cache(key, dashboard_data, output_format))
+    return output
+
+def render_and_cache(key : str, dashboard_data : dict, output_format : str) -> bytes:
+    output = render_dashboard(dashboard_data, output_format)
+    render_cache.put(key, output)
+    return output
+
+def prefetch_dashboard():
+    # Runs on the scheduler's thread, with a request context of its own since the Google sources use the session
+    with app.test_request_context():
+        dashboard_data = fetch_dashboard_data()
+
+        # Render the formats requested since startup
+        for output_format in list(prefetch_formats):
+            get_or_render_dashboard(render_key(dashboard_data, output_format), dashboard_data, output_format)
+
+    return dashboard_data
+
+# Fetch the sources and render the dashboard a few minutes before each wake of the Pi
+prefetch_scheduler = PrefetchScheduler(prefetch_dashboard, wake_times=WAKE_SCHEDULE, timezone=LOCAL_TIMEZONE, lead_minutes=PREFETCH_LEAD_MINUTES)
+prefetch_scheduler.start()
+
+def send_dashboard(output_format : str, mimetype : str, battery_percentage : str = None):
+    prefetch_formats.add(output_format)
+
+    # Use the data prefetched before the Pi's wake if it is recent enough, its render is then already cached
+    dashboard_data = prefetch_scheduler.get(max_age=PREFETCH_MAX_AGE)
+    if dashboard_data is not None:
+        print("Using prefetched dashboard data")
+        flask.g.source_timings = {"prefetch": 0}
+    else:
+        dashboard_data = fetch_dashboard_data()
+
+    # The ETag also depends on the battery percentage drawn on the framebuffer
+    key = render_key(dashboard_data, output_format)
+    etag = RenderCache.make_key(key, battery_percentage) if battery_percentage else key
+
+    # The client already displays this exact dashboard : answer 304 without rendering anything
+    if etag in flask.request.if_none_match:
+        print("Dashboard unchanged, sending 304")
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+    else:
+        output = get_or_render_dashboard(key, dashboard_data, output_format)
+
+        # The Pi can't draw on a framebuffer, so the battery percentage is added here, on a copy of the cached render
+        if output_format == "framebuffer" and battery_percentage:
+            framebuffer = Image_transform.from_epd_buffer(output)
+            framebuffer.draw_battery_percentage(battery_percentage)
+            output_stream = BytesIO()
+            framebuffer.save_epd_buffer(output_path_or_stream=output_stream)
+            output = output_stream.getvalue()
+
+        response = send_file(BytesIO(output), mimetype=mimetype, etag=etag)
+
+    # Report how long each data source took, e.g. in the browser's developer tools
+    response.headers["Server-Timing"] = ", ".join(f"{name};dur={duration:.0f}" for name, duration in flask.g.source_timings.items())
+    return response
+
+# fetch the sources and render the dashboard now, for an external scheduler (e.g. Cloud Scheduler) calling it before each wake of the Pi
+# on Cloud Run, the scheduler's background thread doesn't run while the service is scaled to zero or between requests
+@app.route('/prefetch', methods=['GET', 'POST'])
+def prefetch():
+    if prefetch_scheduler.run():
+        return "Dashboard prefetched", 200
+    return "Prefetch failed", 503
+
+# display dashboard homepage
+@app.route('/dashboard_homepage')
+def draw_homepage():
+    return send_dashboard(output_format="png", mimetype="image/png")
+
+# output the dashboard as the raw framebuffer of the 7.5 inch V2 e-paper panel
+# the Pi sends its battery level as a query parameter, e.g. /dashboard_framebuffer?battery=85
+@app.route('/dashboard_framebuffer')
+def draw_homepage_framebuffer():
+    return send_dashboard(output_format="framebuffer", mimetype="application/octet-stream",
+                          battery_percentage=flask.request.args.get('battery'))
 
 
 # display image pulled from gmail
@@ -344,6 +643,9 @@ def oauth2callback():
   # Save credentials to flask session
   flask.session[token_name] = credentials_as_json
 
+  # Share them with the clients without a session (the Pi) until the process restarts
+  credential_store.put(flask.session['service_name'], credentials)
+
   return (f"Copy this token to your .env file under the {token_name} variable: <br><br>{credentials_as_json} <br><br>"
     "<a href='/'><button>Return to Index</button></a>")
 
@@ -0,0 +1,182 @@
+import os
+import re
+import threading
+import functools
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from svg_updater import SVGFile
+from eink_image import Image_transform, DASHBOARD_WIDTH, DASHBOARD_HEIGHT, FONT_PATH
+from render_plan import PlannedSVGFile, RecordedElement
+
+# Groups of weather icons, only one icon of each group is revealed by SVGFile.handle_icon_code
+ICON_GROUP_IDS = ["weather_icon", "period1_weather_icon", "period2_weather_icon"]
+
+# Arrows revealed or hidden by SVGFile.handle_temp_type
+ARROW_IDS = ["up_arrow_period1", "down_arrow_period1", "up_arrow_period2", "down_arrow_period2"]
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(size : int):
+    # Fonts are loaded once per size and shared between threads
+    return ImageFont.truetype(FONT_PATH, size)
+
+
+class PillowLayout:
+    """
+    The fixed 800x480 layout of the SVG template, drawn with Pillow instead of cairo.
+
+    Everything that never changes (frames, fixed icons, boxes, hidden elements left out) is rasterized once as a base layer.
+    Text slots are drawn with ImageDraw and the Roboto-Medium font, at the positions and sizes read from the template.
+    Weather icons and arrows are rasterized once each, the first time they are revealed, and pasted over the base layer.
+    """
+
+    # Compiled layouts shared by every request of this process, keyed by path: {path: (mtime, layout)}
+    _layout_cache = {}
+    _layout_lock = threading.Lock()
+
+    def __init__(self, template_svg_filepath : str):
+        self.template_svg_filepath = template_svg_filepath
+        svg_file = SVGFile(template_svg_filepath=template_svg_filepath)
+        _, id_index, group_index, _ = SVGFile.load_template(template_svg_filepath)
+        elements = svg_file._elements
+
+        # Declarations of each CSS class of the template's stylesheet, e.g. {"st5": {"font-size": "19px"}}
+        self.class_styles = {}
+        for style in svg_file.root.iter("{http://www.w3.org/2000/svg}style"):
+            for selectors, declarations in re.findall(r'([^{}]+)\{([^}]*)\}', style.text or ""):
+                parsed = dict(re.findall(r'([\w-]+)\s*:\s*([^;]+?)\s*(?:;|$)', declarations))
+                for class_name in re.findall(r'\.([\w-]+)', selectors):
+                    self.class_styles.setdefault(class_name, {}).update(parsed)
+
+        # Position, font size and anchor of each text slot
+        self.text_specs = {position: self.text_spec(elements[position].attrib) for position in id_index.values()
+                           if elements[position].tag == "{http://www.w3.org/2000/svg}text"}
+
+        # Icons the handlers can reveal, by position
+        toggle_positions = [position for group_id in ICON_GROUP_IDS for position in group_index.get(group_id, [])]
+        toggle_positions += [id_index[arrow_id] for arrow_id in ARROW_IDS if arrow_id in id_index]
+        self.toggle_ids = {position: elements[position].get("id") for position in toggle_positions if elements[position].get("id")}
+        self._icons = {}
+        self._icons_lock = threading.Lock()
+
+        # The base layer is the template without its text slots and icons
+        for position in list(self.text_specs) + list(self.toggle_ids):
+            elements[position].getparent().remove(elements[position])
+        svg_file.prune_hidden()
+        self.base_layer = Image_transform(path_or_image=svg_file.to_bytes()).image
+
+    @classmethod
+    def load(cls, template_svg_filepath : str):
+        """
+        Return the compiled layout of the template, compiling it only once per process.
+
+        The layout is compiled again when the file's modification time changes.
+        """
+        mtime = os.path.getmtime(template_svg_filepath)
+        with cls._layout_lock:
+            cached = cls._layout_cache.get(template_svg_filepath)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, cls(template_svg_filepath))
+                cls._layout_cache[template_svg_filepath] = cached
+            return cached[1]
+
+    def text_spec(self, attributes : dict):
+        """
+        Return the position, font size and Pillow anchor of a text element from its attributes.
+
+        The position comes from the x/y attributes or from the translation of the transform matrix.
+        """
+        if "x" in attributes:
+            xy = (float(attributes["x"]), float(attributes["y"]))
+        else:
+            matrix = re.findall(r'-?[\d.]+', attributes.get("transform", "0 0"))
+            xy = (float(matrix[-2]), float(matrix[-1]))
+
+        declarations = {}
+        for class_name in attributes.get("class", "").split():
+            declarations.update(self.class_styles.get(class_name, {}))
+        font_size = round(float(declarations.get("font-size", "16px").rstrip("px")))
+
+        # SVG anchors text on its baseline, at its start, unless told otherwise
+        horizontal = {"middle": "m", "end": "r"}.get(attributes.get("text-anchor"), "l")
+        vertical = "m" if attributes.get("dominant-baseline") == "central" else "s"
+        return xy, font_size, horizontal + vertical
+
+    def icon(self, position : int):
+        """
+        Return the bounding box and the 1-bit bitmap of an icon, rasterizing it the first time only.
+
+        Returns None if the icon draws nothing.
+        """
+        with self._icons_lock:
+            if position in self._icons:
+                return self._icons[position]
+
+        icon_svg = SVGFile(template_svg_filepath=self.template_svg_filepath)
+        icon_svg._elements[position].set("class", "revealed")
+        icon_svg.prune_hidden()
+        icon_svg.keep_only_elements([self.toggle_ids[position]])
+        image = Image_transform(path_or_image=icon_svg.to_bytes()).image
+
+        # Only keep the black pixels' bounding box
+        box = ImageChops.invert(image.convert("L")).getbbox()
+        icon = (box, image.crop(box)) if box else None
+
+        with self._icons_lock:
+            self._icons[position] = icon
+        return icon
+
+    def draw(self, planned_svg : PlannedSVGFile):
+        """
+        Draw the dashboard recorded by the update_svg handlers of a PlannedSVGFile, as a 1-bit image.
+        """
+        image = self.base_layer.copy()
+
+        # Paste the revealed icons, black wins
+        for position in self.toggle_ids:
+            element = planned_svg._elements.get(position)
+            if element is None or element.removed or planned_svg.is_hidden(element):
+                continue
+            icon = self.icon(position)
+            if icon is not None:
+                box, bitmap = icon
+                image.paste(ImageChops.logical_and(image.crop(box), bitmap), box[:2])
+
+        # Draw the text in grayscale, then threshold it the same way as the rasterized SVG
+        text_layer = Image.new("L", (DASHBOARD_WIDTH, DASHBOARD_HEIGHT), 255)
+        draw = ImageDraw.Draw(text_layer)
+
+        texts = []
+        for position, spec in self.text_specs.items():
+            element = planned_svg._elements[position]
+            if element.removed or planned_svg.is_hidden(element):
+                continue
+            texts.append((spec, element.text if element.text is not None else planned_svg.plan.texts[position]))
+
+        # Lines of the multi-line text blocks (grocery, calendar, forecast)
+        for attributes, text in planned_svg._appended_lines:
+            if not planned_svg.is_hidden(RecordedElement("{http://www.w3.org/2000/svg}text", attributes)):
+                texts.append((self.text_spec(attributes), text))
+
+        for (xy, font_size, anchor), text in texts:
+            if text:
+                draw.text(xy, text, font=load_font(font_size), fill=0, anchor=anchor)
+
+        return ImageChops.logical_and(image, text_layer.convert("1", dither=Image.Dither.NONE))
+
+
+class PillowSVGFile(PlannedSVGFile):
+    """
+    Drop-in replacement for SVGFile that draws the dashboard with Pillow instead of rasterizing the SVG with cairo.
+
+    The same update_svg handlers run on the compiled RenderPlan, to_bytes still gives the SVG for debugging.
+    The output is close to cairo's but not pixel-identical: text is drawn with Roboto-Medium, without bold.
+    """
+
+    def __init__(self, template_svg_filepath : str, output_filename: str = None):
+        super().__init__(template_svg_filepath=template_svg_filepath, output_filename=output_filename)
+        self.layout = PillowLayout.load(template_svg_filepath)
+
+    def rasterize(self, use_static_layer : bool = False):
+        # The base layer of the layout already holds the static layer
+        return Image_transform(path_or_image=self.layout.draw(self), rasterized_dashboard=True)
@@ -0,0 +1,75 @@
+import time
+import datetime
+import threading
+from zoneinfo import ZoneInfo
+
+
+class PrefetchScheduler:
+    """
+    Run a job a few minutes before each wake of the Pi, on a background thread, and keep its result ready.
+
+    The Pi wakes at fixed local times (set by screen/alarm.sh), so its request finds the data already fetched
+    instead of waiting on every source while its WiFi is on.
+
+    The background thread needs an instance that stays up with its CPU allocated between requests.
+    Otherwise run() can be called by an external scheduler instead, through the /prefetch route.
+    """
+
+    def __init__(self, job, wake_times : str, timezone : str, lead_minutes : float = 3, check_interval : int = 60):
+        self.job = job  # function returning the result to keep
+        self.wake_times = self.parse_wake_times(wake_times)
+        self.timezone = ZoneInfo(timezone)
+        self.lead = datetime.timedelta(minutes=lead_minutes)  # the job runs this long before each wake
+        self.check_interval = check_interval  # longest sleep, so a change of the system clock is noticed
+        self._latest = None  # (monotonic time of the run, result)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def parse_wake_times(wake_times : str) -> list:
+        # "06:01,18:01" -> [time(6, 1), time(18, 1)]
+        return sorted(datetime.time.fromisoformat(wake_time.strip()) for wake_time in wake_times.split(",") if wake_time.strip())
+
+    def next_run(self, now : datetime.datetime = None) -> datetime.datetime:
+        """Return the next time the job should run, in the local timezone."""
+        now = now or datetime.datetime.now(self.timezone)
+        for days in (0, 1, 2):
+            date = now.date() + datetime.timedelta(days=days)
+            for wake_time in self.wake_times:
+                run_at = datetime.datetime.combine(date, wake_time, tzinfo=self.timezone) - self.lead
+                if run_at > now:
+                    return run_at
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.wake_times:
+                self._thread = threading.Thread(target=self._run_loop, name="prefetch-scheduler", daemon=True)
+                self._thread.start()
+                print(f"Prefetch scheduled at {self.next_run():%Y-%m-%d %H:%M}")
+
+    def _run_loop(self):
+        while True:
+            run_at = self.next_run()
+            while (delay := (run_at - datetime.datetime.now(self.timezone)).total_seconds()) > 0:
+                time.sleep(min(delay, self.check_interval))
+            self.run()
+
+    def run(self) -> bool:
+        # Run the job now and keep its result, a failure keeps the previous result until it expires
+        start = time.perf_counter()
+        try:
+            result = self.job()
+        except Exception as error:
+            print(f"Prefetch failed: {error!r}")
+            return False
+        with self._lock:
+            self._latest = (time.monotonic(), result)
+        print(f"Prefetch done in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return True
+
+    def get(self, max_age : float):
+        """Return the result of the last run if it is at most max_age seconds old, None otherwise."""
+        with self._lock:
+            if self._latest is None or time.monotonic() - self._latest[0] > max_age:
+                return None
+            return self._latest[1]
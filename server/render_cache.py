@@ -0,0 +1,39 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class RenderCache:
+    """Keep the most recent dashboard renders in memory, keyed by a hash of the data they were rendered from."""
+
+    def __init__(self, max_entries : int = 8):
+        self.max_entries = max_entries
+        self._renders = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*inputs) -> str:
+        """
+        Return a stable hash of the inputs of a render (the dicts passed to SVGFile.update_svg, output format...).
+
+        The same data always gives the same key, whatever the process, so it can be used as an ETag.
+        """
+        serialized = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key : str):
+        # Return the cached render, or None if it is not cached
+        with self._lock:
+            render = self._renders.get(key)
+            if render is not None:
+                self._renders.move_to_end(key)
+            return render
+
+    def put(self, key : str, render : bytes):
+        # Store a render, dropping the least recently used one when the cache is full
+        with self._lock:
+            self._renders[key] = render
+            self._renders.move_to_end(key)
+            while len(self._renders) > self.max_entries:
+                self._renders.popitem(last=False)
@@ -0,0 +1,282 @@
+import os
+import re
+import threading
+import contextlib
+
+from svg_updater import SVGFile
+
+# Markers written in the template while compiling it, found back in its serialization: \ue000<kind><position>\ue001
+# They use characters of Unicode's private use area, which never appear in the template.
+# Kinds are S/E (start and end of an element that can be removed), T (text of an element) and C (class of an element)
+MARKER = re.compile("\ue000([SETC])(\\d+)\ue001")
+
+# Characters libxml2 refuses in text and attributes
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def escape_text(text : str) -> str:
+    # Escape text content exactly like lxml does when serializing
+    if INVALID_XML_CHARS.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+
+
+def escape_attribute(value : str) -> str:
+    # Escape an attribute value exactly like lxml does when serializing
+    return (escape_text(value).replace('"', "&quot;")
+            .replace("\n", "&#10;").replace("\t", "&#9;"))
+
+
+class RecordedElement:
+    """Stands in for an element of the template in a PlannedSVGFile: it records what the SVGFile handlers change."""
+
+    def __init__(self, tag : str, attrib : dict):
+        self.tag = tag
+        self.attrib = dict(attrib)
+        self.text = None  # None until a handler sets it
+        self.removed = False
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+
+class RenderPlan:
+    """
+    The SVG template compiled into pre-serialized byte segments and typed slots.
+
+    The slots are the parts of the template the SVGFile handlers can change:
+    - text slots: the text of every text element with an id (single values, uv index...)
+    - class slots: the class of every element with an id and of every indexed group (icon selectors, arrow toggles)
+    - element slots: every element that can be removed (multi-line text blocks, hidden elements when pruning)
+    Lines of the multi-line text blocks (grocery, calendar, forecast) are appended at the end of the document.
+
+    Filling the plan gives the exact bytes of SVGFile.to_bytes() for the same data.
+    """
+
+    # Compiled plans shared by every request of this process, keyed by path: {path: (mtime, plan)}
+    _plan_cache = {}
+    _plan_lock = threading.Lock()
+
+    def __init__(self, template_svg_filepath : str):
+        # Compile a private copy of the template, with the same indexes as the SVGFile handlers use
+        svg_file = SVGFile(template_svg_filepath=template_svg_filepath)
+        _, self.id_index, self.group_index, self.hidden_classes = SVGFile.load_template(template_svg_filepath)
+
+        elements = svg_file._elements
+        slot_positions = set(self.id_index.values())
+        for positions in self.group_index.values():
+            slot_positions.update(positions)
+        slot_positions.discard(0)  # the root is never changed
+
+        # Hidden elements are removable too, so the plan can render pruned and unpruned documents
+        removable_positions = slot_positions | {position for position, element in enumerate(elements)
+                                                if position and svg_file.is_hidden(element)}
+
+        # Keep the original state of every element the plan can change
+        self.tags = {}
+        self.attributes = {}
+        self.texts = {}
+        for position in sorted(removable_positions):
+            element = elements[position]
+            self.tags[position] = element.tag
+            self.attributes[position] = dict(element.attrib)
+            self.texts[position] = element.text
+
+        # Write the markers in document order, so an element's text marker comes before its children's start markers
+        for position in sorted(removable_positions):
+            element = elements[position]
+            if element.tag == "{http://www.w3.org/2000/svg}text" and position in slot_positions:
+                element.text = self.marker("T", position)
+            if position in slot_positions:
+                element.set("class", self.marker("C", position))
+
+            previous = element.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or "") + self.marker("S", position)
+            else:
+                parent = element.getparent()
+                parent.text = (parent.text or "") + self.marker("S", position)
+            element.tail = (element.tail or "") + self.marker("E", position)
+
+        # Multi-line text blocks are appended just before the closing tag of the root
+        serialized = svg_file.to_bytes().decode("utf-8")
+        closing_tag = serialized.rindex("</svg>")
+        self.segments = self.split_segments(serialized[:closing_tag])
+        self.closing = serialized[closing_tag:].encode("utf-8")
+
+        # Safety net: without any data, the plan must give back the template exactly, pruned or not
+        reference = SVGFile(template_svg_filepath=template_svg_filepath)
+        untouched_elements = {position: RecordedElement(self.tags[position], attributes) for position, attributes in self.attributes.items()}
+        for pruned in (False, True):
+            if pruned:
+                reference.prune_hidden()
+            if self.render(untouched_elements, [], pruned, reference.is_hidden) != reference.to_bytes():
+                raise ValueError(f"{template_svg_filepath} can't be compiled into a render plan")
+
+    @staticmethod
+    def marker(kind : str, position : int) -> str:
+        return f"\ue000{kind}{position}\ue001"
+
+    @staticmethod
+    def split_segments(serialized : str) -> list:
+        """
+        Split the serialized template on its markers into a nested list of segments.
+
+        Each segment is either bytes, ("T", position), ("C", position) or ("S", position, [segments of the element]).
+        """
+        root_segments = []
+        stack = [root_segments]
+        last_end = 0
+        for match in MARKER.finditer(serialized):
+            text = serialized[last_end:match.start()]
+            kind, position = match.group(1), int(match.group(2))
+
+            if kind == "C":
+                # The slot covers the whole attribute, which may be absent: cut ' class="' before and '"' after the marker
+                text = text[:-len(' class="')]
+                last_end = match.end() + 1
+            else:
+                last_end = match.end()
+
+            if text:
+                stack[-1].append(text.encode("utf-8"))
+
+            if kind == "S":
+                element_segments = []
+                stack[-1].append(("S", position, element_segments))
+                stack.append(element_segments)
+            elif kind == "E":
+                stack.pop()
+            else:
+                stack[-1].append((kind, position))
+
+        if serialized[last_end:]:
+            stack[-1].append(serialized[last_end:].encode("utf-8"))
+        return root_segments
+
+    @classmethod
+    def load(cls, template_svg_filepath : str):
+        """
+        Return the compiled plan of the template, compiling it only once per process.
+
+        The plan is compiled again when the file's modification time changes.
+        """
+        mtime = os.path.getmtime(template_svg_filepath)
+        with cls._plan_lock:
+            cached = cls._plan_cache.get(template_svg_filepath)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, cls(template_svg_filepath))
+                cls._plan_cache[template_svg_filepath] = cached
+            return cached[1]
+
+    def render(self, elements : dict, appended_lines : list, pruned : bool, is_hidden) -> bytes:
+        """
+        Join the segments, filling the slots with the recorded elements.
+
+        Parameters:
+        - elements (dict): The RecordedElement of each slot, by position.
+        - appended_lines (list): The (attributes, text) of each line of the multi-line text blocks, in order.
+        - pruned (bool): Whether hidden elements are left out.
+        - is_hidden (function): Tells whether a RecordedElement is hidden.
+        """
+        output = []
+        self.render_segments(self.segments, elements, pruned, is_hidden, output)
+
+        for attributes, text in appended_lines:
+            line = RecordedElement("{http://www.w3.org/2000/svg}text", attributes)
+            if pruned and is_hidden(line):
+                continue
+            serialized_attributes = "".join(f' {key}="{escape_attribute(value)}"' for key, value in attributes.items())
+            output.append(f"<text{serialized_attributes}>{escape_text(text)}</text>".encode("utf-8"))
+
+        output.append(self.closing)
+        return b"".join(output)
+
+    def render_segments(self, segments : list, elements : dict, pruned : bool, is_hidden, output : list):
+        for segment in segments:
+            if isinstance(segment, bytes):
+                output.append(segment)
+                continue
+
+            element = elements[segment[1]]
+            if segment[0] == "S":
+                if element.removed or (pruned and is_hidden(element)):
+                    continue
+                self.render_segments(segment[2], elements, pruned, is_hidden, output)
+            elif segment[0] == "T":
+                text = element.text if element.text is not None else self.texts[segment[1]]
+                if text:
+                    output.append(escape_text(text).encode("utf-8"))
+            elif segment[0] == "C":
+                class_value = element.get("class")
+                if class_value is not None:
+                    output.append(f' class="{escape_attribute(class_value)}"'.encode("utf-8"))
+
+
+class PlannedSVGFile(SVGFile):
+    """
+    Drop-in replacement for SVGFile that fills the compiled RenderPlan of the template instead of modifying a copy of its tree.
+
+    The same update_svg handlers run, on RecordedElement stand-ins, and to_bytes joins the plan's byte segments.
+    """
+
+    def __init__(self, template_svg_filepath : str, output_filename: str = None):
+        self.plan = RenderPlan.load(template_svg_filepath)
+        self.template_svg_filepath = template_svg_filepath
+        self.output_filename = output_filename
+        self._pruned = False
+        self._appended_lines = []
+
+        # Same indexes as SVGFile, pointing to stand-ins of the template's elements
+        self._elements = {position: RecordedElement(self.plan.tags[position], attributes)
+                          for position, attributes in self.plan.attributes.items()}
+        self._elements_by_id = {key: self._elements[position] for key, position in self.plan.id_index.items() if position in self._elements}
+        self._group_index = self.plan.group_index
+        self._hidden_classes = self.plan.hidden_classes
+
+    def replace_text_with_proper_width(self, text_element, new_text, max_width, line_height_for_spacing, max_lines=5):
+        # Record the new lines with the attributes SVGFile gives them: the new transform first, then the original attributes
+        for line, transform in self.position_text_lines(text_element, new_text, max_width, line_height_for_spacing, max_lines):
+            attributes = {'transform': transform}
+            attributes.update((attr, val) for attr, val in text_element.attrib.items() if attr != 'transform')
+            self._appended_lines.append((attributes, line))
+
+        # Remove the original text element
+        text_element.removed = True
+        self._elements_by_id.pop(text_element.get("id"), None)
+
+    def remove_static_layer(self):
+        # The plan leaves the static elements out while joining the segments
+        for element_id in self.static_layer_ids:
+            element = self._elements_by_id.pop(element_id, None)
+            if element is not None:
+                element.removed = True
+
+    def prune_hidden(self):
+        # The plan leaves hidden elements out while joining the segments
+        self._pruned = True
+
+    def to_bytes(self) -> bytes:
+        return self.plan.render(self._elements, self._appended_lines, self._pruned, self.is_hidden)
+
+
+def matches_svg_file(template_svg_filepath : str, **dashboard_data) -> bool:
+    """
+    Check that the plan gives the same bytes as SVGFile for the given update_svg arguments, before and after pruning.
+    """
+    svg_file = SVGFile(template_svg_filepath=template_svg_filepath)
+    planned_svg_file = PlannedSVGFile(template_svg_filepath=template_svg_filepath)
+
+    for svg in (svg_file, planned_svg_file):
+        with contextlib.redirect_stdout(None):
+            svg.update_svg(**dashboard_data)
+
+    if svg_file.to_bytes() != planned_svg_file.to_bytes():
+        return False
+
+    svg_file.prune_hidden()
+    planned_svg_file.prune_hidden()
+    return svg_file.to_bytes() == planned_svg_file.to_bytes()
@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller runs the computation, the others wait for it and share its result.
+
+    Nothing is cached, the next call after the computation finished runs it again.
+    """
+
+    def __init__(self):
+        self._calls = {}  # {key: Future of the computation in flight}
+        self._lock = threading.Lock()
+
+    def do(self, key, compute, timeout : float = None):
+        """
+        Return the result of compute(), or of the call already in flight for the same key.
+
+        The exception raised by the computation is raised in every caller waiting for it.
+        Callers waiting on another call give up after timeout seconds with concurrent.futures.TimeoutError.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            print(f"{key} already in flight, waiting for its result")
+            return call.result(timeout=timeout)
+
+        try:
+            result = compute()
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def wrap(self, key, compute, timeout : float = None):
+        # Return a function calling compute through the single flight, e.g. to submit it to a thread pool
+        return lambda: self.do(key, compute, timeout=timeout)
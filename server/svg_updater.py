@@ -1,19 +1,97 @@
+import os
 import re
+import copy
 import textwrap
+import threading
 from lxml import etree
 
 from io import BytesIO
-from eink_image import Image_transform
+from PIL import ImageChops
+from eink_image import Image_transform, rasterize_svg
 
 
 class SVGFile:
     ns = {'svg': 'http://www.w3.org/2000/svg'}
 
-    def __init__(self, template_svg_filepath : str, output_filename: str):
-        self.tree = etree.parse(template_svg_filepath)
+    # Parsed templates shared by every request of this process, keyed by path: {path: (mtime, tree, id_index, group_index, hidden_classes)}
+    _template_cache = {}
+    _template_lock = threading.Lock()
+
+    # Elements that never change (frames, fixed icons, boxes) : they can be rasterized once as a static layer
+    static_layer_ids = ["frames", "main_icons",
+                        "box_period1", "vertical_bar_period1", "umbrella_period1",
+                        "box_period2", "vertical_bar_period2", "umbrella_period2"]
+
+    # Rasterized static layers, keyed by template path: {path: (mtime, image, drawn pixels mask)}
+    _static_layer_cache = {}
+    _static_layer_lock = threading.Lock()
+
+    def __init__(self, template_svg_filepath : str, output_filename: str = None):
+        self.template_svg_filepath = template_svg_filepath
+        template, id_index, group_index, hidden_classes = SVGFile.load_template(template_svg_filepath)
+
+        # Work on a private copy of the cached template so the handlers can modify it safely
+        self.tree = copy.deepcopy(template)
         self.root = self.tree.getroot()
+        # The render happens in memory, the output file is only written for debugging when a filename is given
         self.output_filename = output_filename
 
+        # The copy has the same structure as the template, so the template's indexes apply to it:
+        # a single walk of the copy maps every id to its element
+        self._elements = list(self.root.iter(etree.Element))
+        self._elements_by_id = {key: self._elements[position] for key, position in id_index.items()}
+        self._group_index = group_index
+        self._hidden_classes = hidden_classes
+
+    @classmethod
+    def load_template(cls, template_svg_filepath : str):
+        """
+        Return the parsed template and its indexes, parsing the file only once per process.
+
+        The cached tree is re-parsed when the file's modification time changes.
+        It is shared between threads and must never be modified: copy it first.
+
+        Returns:
+        - tree (ElementTree): The parsed template.
+        - id_index (dict): The position of each element with an id, in the order of root.iter(etree.Element).
+        - group_index (dict): The positions of all the groups (svg:g) nested in each element with an id.
+        - hidden_classes (set): The CSS classes of the template's stylesheet that set display:none.
+        """
+        mtime = os.path.getmtime(template_svg_filepath)
+        with cls._template_lock:
+            cached = cls._template_cache.get(template_svg_filepath)
+            if cached is None or cached[0] != mtime:
+                tree = etree.parse(template_svg_filepath)
+                cached = (mtime, tree, *cls.build_indexes(tree))
+                cls._template_cache[template_svg_filepath] = cached
+            return cached[1:]
+
+    @staticmethod
+    def build_indexes(tree):
+        # Index elements by their position in the tree, so the indexes can be applied to any copy of it
+        elements = list(tree.getroot().iter(etree.Element))
+        position_of = {element: position for position, element in enumerate(elements)}
+
+        id_index = {}
+        group_index = {}
+        for position, element in enumerate(elements):
+            element_id = element.get("id")
+            if element_id is None or element_id in id_index:
+                continue
+            id_index[element_id] = position
+
+            groups = [position_of[group] for group in element.iterdescendants("{http://www.w3.org/2000/svg}g")]
+            if groups:
+                group_index[element_id] = groups
+
+        # Find the classes that hide elements in the template's stylesheet, e.g. .hidden{display:none;}
+        hidden_classes = set()
+        for style in tree.getroot().iter("{http://www.w3.org/2000/svg}style"):
+            for selectors, declarations in re.findall(r'([^{}]+)\{([^}]*)\}', style.text or ""):
+                if re.search(r'display\s*:\s*none', declarations):
+                    hidden_classes.update(re.findall(r'\.([\w-]+)', selectors))
+
+        return id_index, group_index, hidden_classes
 
     def update_svg(self, current_weather_dict, forecast_period_1_dict, forecast_period_2_dict, grocery_dict, calendar_dict):
         # Update the SVG file's text fields with new data
@@ -47,15 +125,106 @@ class SVGFile:
                 action = actions_dict.get(key, actions_dict["default_replace_text"])
                 action(period_index, svg_key, value)
                 
-        # Compile the new SVG file and output it
-        self.tree.write(self.output_filename, encoding='utf-8', pretty_print=True)
+        # Optionally write the new SVG file to disk for debugging
+        if self.output_filename:
+            with open(self.output_filename, 'wb') as output_file:
+                output_file.write(self.to_bytes())
+
+    def to_bytes(self) -> bytes:
+        # Serialize the updated SVG in memory, exactly as it would be written to disk
+        return etree.tostring(self.tree, encoding='utf-8', pretty_print=True)
+
+    def is_hidden(self, element) -> bool:
+        # An element is hidden by one of the stylesheet's display:none classes or by an inline display:none style
+        if self._hidden_classes.intersection(element.get("class", "").split()):
+            return True
+        return re.search(r'display\s*:\s*none', element.get("style", "")) is not None
+
+    def prune_hidden(self):
+        """
+        Remove the hidden elements (unused weather icons, hidden arrows...) from the copy being rendered.
+
+        The rasterizer would otherwise parse, style and walk every hidden path before skipping it.
+        """
+        hidden_elements = [element for element in self.root.iter(etree.Element) if self.is_hidden(element)]
+        for element in hidden_elements:
+            element.getparent().remove(element)
+
+    def remove_static_layer(self):
+        # Keep only the dynamic layer : remove the elements that are rasterized once in the static layer
+        for element_id in self.static_layer_ids:
+            element = self._elements_by_id.pop(element_id, None)
+            if element is not None:
+                element.getparent().remove(element)
+
+    def keep_only_static_layer(self):
+        # Keep only the static layer : remove everything that isn't a static element, one of their ancestors or a stylesheet
+        self.keep_only_elements(self.static_layer_ids)
+
+    def keep_only_elements(self, element_ids : list):
+        # Remove everything that isn't one of the elements, one of their ancestors or a stylesheet
+        kept_elements = [self._elements_by_id[element_id] for element_id in element_ids if element_id in self._elements_by_id]
+        kept = set()
+        for element in kept_elements:
+            kept.update(element.iterancestors())
+            kept.update(element.iter())
+
+        for element in list(self.root.iter(etree.Element)):
+            if element not in kept and element.tag != "{http://www.w3.org/2000/svg}style" and element.getparent() in kept:
+                element.getparent().remove(element)
+
+    @staticmethod
+    def drawn_pixels(image):
+        # 1-bit mask of the pixels something was drawn on (anything but the white background, antialiased edges included)
+        return image.point(lambda level: 255 if level < 255 else 0, "1")
+
+    @classmethod
+    def load_static_layer(cls, template_svg_filepath : str):
+        """
+        Return the static layer of the template as a grayscale image, and the mask of its drawn pixels, rasterizing it only once per process.
 
-    def send_to_pi(self):
+        The static layer is rasterized again when the file's modification time changes.
+        The images are shared between threads and must never be modified.
+        """
+        mtime = os.path.getmtime(template_svg_filepath)
+        with cls._static_layer_lock:
+            cached = cls._static_layer_cache.get(template_svg_filepath)
+            if cached is None or cached[0] != mtime:
+                static_svg = SVGFile(template_svg_filepath=template_svg_filepath)
+                static_svg.prune_hidden()
+                static_svg.keep_only_static_layer()
+                static_layer = rasterize_svg(static_svg.to_bytes())
+                cached = (mtime, static_layer, SVGFile.drawn_pixels(static_layer))
+                cls._static_layer_cache[template_svg_filepath] = cached
+            return cached[1:]
+
+    def rasterize(self, use_static_layer : bool = False):
+        # Nothing hidden needs to be rasterized
+        self.prune_hidden()
+
+        if not use_static_layer:
+            # Hand the serialized SVG straight to the rasterizer, no temporary file involved
+            return Image_transform(path_or_image=self.to_bytes())
+
+        # Only rasterize the dynamic layer, and composite it over the cached static layer
+        static_layer, static_drawn = SVGFile.load_static_layer(self.template_svg_filepath)
+        full_svg = self.to_bytes()
+        self.remove_static_layer()
+        dynamic_layer = rasterize_svg(self.to_bytes())
+
+        # Where one layer is white, multiplying the gray levels gives the other layer's pixel unchanged, exactly as a full render.
+        # Where both layers drew something, antialiased edges blend differently: the whole SVG is rasterized instead.
+        # (This relies on the template drawing no white shapes, which would cover the other layer without showing in its mask.)
+        if ImageChops.logical_and(static_drawn, SVGFile.drawn_pixels(dynamic_layer)).getbbox() is not None:
+            return Image_transform(path_or_image=full_svg)
+        return Image_transform(path_or_image=ImageChops.multiply(dynamic_layer, static_layer), rasterized_dashboard=True)
+
+    def send_to_pi(self, use_static_layer : bool = False):
 
         # initialize bytes output stream
         output_stream = BytesIO()
 
-        transformed_svg = Image_transform(path_or_image=self.output_filename)
+        transformed_svg = self.rasterize(use_static_layer)
         transformed_svg.save(output_path_or_stream = output_stream)
 
         # display the image (don't cache it)
@@ -64,6 +233,17 @@ class SVGFile:
 
         return output_stream
 
+    def send_framebuffer_to_pi(self, use_static_layer : bool = False):
+        # Same as send_to_pi, but outputs the raw 48,000 bytes framebuffer of the e-paper panel instead of a PNG
+        # The battery percentage is drawn later, on a copy of the cached framebuffer
+        output_stream = BytesIO()
+
+        transformed_svg = self.rasterize(use_static_layer)
+        transformed_svg.save_epd_buffer(output_path_or_stream = output_stream)
+        output_stream.seek(0)
+
+        return output_stream
+
     def find_svg_element_by_id(self, key):
         """
         Find an SVG text element by its ID attribute.
@@ -74,22 +254,18 @@ class SVGFile:
         Returns:
         - Element: The found SVG text element. None if not found.
         """
-        try:
-            return self.root.find(f".//svg:text[@id='{key}']", namespaces=SVGFile.ns)
-        except Exception as e:
-            print(f"Error finding text element with key '{key}': {str(e)}")
-            return None
+        element = self._elements_by_id.get(key)
+        if element is not None and element.tag == "{http://www.w3.org/2000/svg}text":
+            return element
+        return None
 
     def find_single_shape(self, id: str):
-        return self.root.find(f".//svg:*[@id='{id}']", namespaces=SVGFile.ns)
+        return self._elements_by_id.get(id)
 
     def find_group_of_shapes(self, group_name):
-        group = self.root.find(f".//svg:*[@id='{group_name}']", namespaces=SVGFile.ns)
-        if group is not None:
-            return [subgroup for subgroup in group.findall(".//svg:g", namespaces=SVGFile.ns)]
-        return []
+        return [self._elements[position] for position in self._group_index.get(group_name, [])]
 
-    def replace_text_with_proper_width(self, text_element, new_text, max_width, line_height_for_spacing, max_lines=5):
+    def position_text_lines(self, text_element, new_text, max_width, line_height_for_spacing, max_lines=5):
         # Split the new text into lines based on max_width
         splits = self.format_text_length(new_text, max_width, max_lines = max_lines)
         
@@ -101,18 +277,22 @@ class SVGFile:
         # Set spaces between lines
         line_height = line_height_for_spacing
         
+        # Return each line of text with the transform that positions it
+        return [(line, f"matrix(1 0 0 1 {original_x} {start_y + (line_height * index)})") for index, line in enumerate(splits)]
+
+    def replace_text_with_proper_width(self, text_element, new_text, max_width, line_height_for_spacing, max_lines=5):
         # Create new text elements for each line of text
-        for index, line in enumerate(splits):
+        for line, transform in self.position_text_lines(text_element, new_text, max_width, line_height_for_spacing, max_lines):
             new_text_element = etree.SubElement(self.root, "{http://www.w3.org/2000/svg}text")
             new_text_element.text = line
-            new_y = start_y + (line_height * index)
-            new_text_element.set('transform', f"matrix(1 0 0 1 {original_x} {new_y})")
+            new_text_element.set('transform', transform)
             for attr, val in text_element.attrib.items():
                 if attr != 'transform':
                     new_text_element.set(attr, val)
         
         # Remove the original text element from the SVG after creating the new ones
         text_element.getparent().remove(text_element)
+        self._elements_by_id.pop(text_element.get("id"), None)
     
     def convert_to_clean_bullet_points(self, text : list) -> str:
         # We are adding a non-breaking space to prevent lines splitting after the bullet point